@@ -0,0 +1,76 @@
+"""
+Startup benchmark for the Flask app.
+
+Imports src/app.py in a fresh interpreter with `python -X importtime`, in a
+throwaway working directory so no real database is touched, and reports the
+total import time and the slowest imports. Fails (exit code 1) if importing
+took longer than --max-ms or pulled in a broker SDK, cryptography or numpy eagerly.
+
+    python benchmarks/bench_startup.py [--max-ms 800] [--top 15]
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+# Packages that must only be imported once a broker logs in, a setting is decrypted or bars are flushed
+LAZY_PACKAGES = ('kiteconnect', 'upstox_client', 'websocket', 'cryptography', 'numpy')
+
+def parse_importtime(stderr):
+    """Returns (cumulative_us, package) for every top-level entry of -X importtime output."""
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, package = line[len('import time:'):].split('|')
+        entries.append((int(cumulative), package.rstrip()))
+    return entries
+
+def is_top_level(package):
+    return package.startswith(' ') and not package.startswith('  ')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--max-ms', type=float, default=800.0)
+    parser.add_argument('--top', type=int, default=15)
+    args = parser.parse_args()
+
+    env = dict(os.environ, PYTHONPATH=os.path.abspath(SRC_DIR) + os.pathsep + os.environ.get("PYTHONPATH", ""))
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import app'],
+        cwd=tempfile.mkdtemp(), env=env, capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        print(result.stderr.splitlines()[-1] if result.stderr else 'import failed')
+        return 1
+
+    entries = parse_importtime(result.stderr)
+    app_index = max(i for i, (_, package) in enumerate(entries) if package == ' app')
+    total_ms = entries[app_index][0] / 1000
+
+    print(f"import app: {total_ms:.1f} ms")
+    # Nesting is shown by indentation: one space at the top level, two more per level.
+    # A module is listed after everything it imports, so app's own imports are the
+    # entries between the previous top-level entry and app itself.
+    block_start = max((i + 1 for i, (_, package) in enumerate(entries[:app_index]) if is_top_level(package)), default=0)
+    print("slowest direct imports of app:")
+    direct = [(cumulative, package.strip()) for cumulative, package in entries[block_start:app_index]
+              if package.startswith('   ') and not package.startswith('     ')]
+    for cumulative, package in sorted(direct, reverse=True)[:args.top]:
+        print(f"  {cumulative / 1000:>8.1f} ms  {package}")
+
+    failed = False
+    eager = sorted({package.strip().split('.')[0] for _, package in entries} & set(LAZY_PACKAGES))
+    if eager:
+        print(f"FAIL: imported eagerly: {', '.join(eager)}")
+        failed = True
+    if total_ms > args.max_ms:
+        print(f"FAIL: import took {total_ms:.1f} ms (limit {args.max_ms:.0f} ms)")
+        failed = True
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
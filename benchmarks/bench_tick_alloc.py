@@ -0,0 +1,104 @@
+"""
+Allocation benchmark for the tick hot path.
+
+Compares the current process_tick (NormalizedTick + in-memory Position book)
+with the pre-records path, which looked the order up with SELECT * per tick and
+walked the raw tick dicts. Reports the peak transient memory and the time per
+tick measured with tracemalloc.
+
+    python benchmarks/bench_tick_alloc.py [--ticks N]
+"""
+import argparse
+import os
+import queue
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import db
+
+INSTRUMENT_TOKEN = 408065
+
+def make_tick(price):
+    """A Zerodha full-mode tick, shaped like what KiteTicker delivers."""
+    return {
+        'instrument_token': INSTRUMENT_TOKEN,
+        'last_price': price,
+        'volume_traded': 1000,
+        'depth': {
+            'buy': [{'price': price - 0.05 * (i + 1), 'quantity': 10, 'orders': 1} for i in range(5)],
+            'sell': [{'price': price + 0.05 * (i + 1), 'quantity': 10, 'orders': 1} for i in range(5)],
+        },
+    }
+
+def legacy_process_tick(instrument_token, tick_data):
+    """The lookup half of the pre-records process_tick: per-tick SELECT, sqlite3.Row and float() conversions."""
+    ltp = tick_data.get('last_price')
+    best_bid = None
+    if 'depth' in tick_data:
+        try:
+            best_bid = tick_data['depth']['buy'][0]['price']
+        except (IndexError, KeyError):
+            best_bid = None
+    conn = db.get_db_connection()
+    order = conn.execute(
+        'SELECT * FROM orders WHERE status = "OPEN" AND instrument_key = ?',
+        (str(instrument_token),)
+    ).fetchone()
+    if order:
+        float(order['price'])
+        stoploss_percent = float(order['initial_stoploss'])
+        current_stoploss_price = float(order['current_stoploss_price'])
+        if ltp > current_stoploss_price and order['product'] in ['MIS', 'NRML']:
+            best_bid * (1 - stoploss_percent / 100)
+    conn.close()
+
+def measure(label, handler, ticks):
+    tracemalloc.start()
+    peaks = 0
+    started = time.perf_counter()
+    for tick in ticks:
+        baseline = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        handler(tick['instrument_token'], tick)
+        peaks += tracemalloc.get_traced_memory()[1] - baseline
+    elapsed = time.perf_counter() - started
+    tracemalloc.stop()
+    print(f"{label:<12} {peaks / len(ticks):>10.0f} B/tick peak  {elapsed / len(ticks) * 1e6:>8.1f} us/tick (traced)")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--ticks', type=int, default=5000)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    db.DATABASE_NAME = os.path.join(workdir, 'bench.db')
+    db.init_db()
+    conn = db.get_db_connection()
+    # A stop far below the market so every tick runs the full trailing check without a write
+    conn.execute(
+        'INSERT INTO orders (order_id, symbol, quantity, price, initial_stoploss, current_stoploss_price, status, broker, transaction_type, exchange, product, instrument_key) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        ('BENCH1', 'INFY', 1, 1500.0, 50.0, 1400.0, 'OPEN', 'Zerodha', 'BUY', 'NSE', 'MIS', str(INSTRUMENT_TOKEN))
+    )
+    conn.commit()
+    conn.close()
+
+    from websocket_manager import ZerodhaWebSocketManager
+    manager = ZerodhaWebSocketManager(broker='Zerodha', access_token=None, order_queue=queue.Queue())
+    manager.load_positions()
+
+    ticks = [make_tick(1500.0) for _ in range(args.ticks)]
+    # Warm both paths so one-off allocations (statement cache, trackers) are not counted
+    for tick in ticks[:100]:
+        legacy_process_tick(tick['instrument_token'], tick)
+        manager.process_tick(tick['instrument_token'], tick)
+
+    measure('legacy', legacy_process_tick, ticks)
+    measure('records', manager.process_tick, ticks)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+"""
+End-to-end load test against the fake broker.
+
+Opens one position per instrument, streams ticks for N instruments at M ticks/s
+each through the fake broker's ticker into the real WebSocket manager, order
+worker and outbox, then gaps every instrument through its stop once at a
+random moment. Tick-to-exit latency is the time from publishing that gap tick
+to the exit order reaching the fake broker.
+
+    python benchmarks/load_generator.py --instruments 50 --rate 10 --duration 10
+    python benchmarks/load_generator.py --instruments 200 --sweep 5,10,20,50,100
+
+With --sweep, each rate runs in a fresh process and database, and the first
+rate where the feed falls behind or p99 latency exceeds --max-p99-ms is
+reported as the saturation point.
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+def instrument_keys(broker, count):
+    if broker == 'Zerodha':
+        return [str(100000 + i) for i in range(count)]
+    return [f"NSE_EQ|FAKE{i:05d}" for i in range(count)]
+
+def run_once(args):
+    """Runs one load level in this process and returns the measurements."""
+    os.environ['FAKE_BROKER'] = '1'
+    os.chdir(tempfile.mkdtemp())
+    sys.path.insert(0, os.path.abspath(SRC_DIR))
+
+    import app
+    import fake_broker
+    from db import get_db_connection, ensure_db_initialized
+    from websocket_manager import ZerodhaWebSocketManager, UpstoxWebSocketManager
+
+    exchange = fake_broker.default_exchange
+    exchange.configure(latency=args.latency_ms / 1000, rate_limit=args.rate_limit, reject_rate=args.reject_rate)
+
+    ensure_db_initialized()
+    broker = args.broker
+    keys = instrument_keys(broker, args.instruments)
+    symbols = {}
+    conn = get_db_connection()
+    for i, key in enumerate(keys):
+        symbol = f"FAKE{i:05d}"
+        symbols[symbol] = key
+        entry_order_id = f"ENTRY{i}"
+        # Entry orders stay OPEN at the broker so the connect-time order sync leaves them alone
+        exchange.orders[entry_order_id] = {'order_id': entry_order_id, 'broker': broker, 'status': 'OPEN', 'tag': None}
+        conn.execute(
+            'INSERT INTO orders (order_id, symbol, quantity, price, initial_stoploss, current_stoploss_price, status, broker, transaction_type, exchange, product, instrument_key) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (entry_order_id, symbol, 1, 100.0, 1.0, 99.0, 'OPEN', broker, 'BUY', 'NSE', 'CNC', key)
+        )
+    conn.commit()
+    conn.close()
+
+    app.ACCESS_TOKENS[broker.lower()] = 'fake'
+    if broker == 'Zerodha':
+        manager = ZerodhaWebSocketManager(broker='Zerodha', access_token='fake', order_queue=app.order_queue,
+                                          api_key='fake', broker_api=app.get_kite(), bar_builder=app.bar_builder,
+                                          risk=app.get_portfolio_risk(), events=app.events)
+    else:
+        manager = UpstoxWebSocketManager(broker='Upstox', access_token='fake', order_queue=app.order_queue,
+                                         broker_api=fake_broker.OrderApi(fake_broker.ApiClient()),
+                                         bar_builder=app.bar_builder, risk=app.get_portfolio_risk(), events=app.events)
+    manager.daemon = True
+    manager.start()
+    deadline = time.time() + 10
+    while not (exchange.tickers and exchange.tickers[0].subscribed >= set(keys)):
+        if time.time() > deadline:
+            raise RuntimeError("Fake ticker did not connect and subscribe in time")
+        time.sleep(0.01)
+    ticker = exchange.tickers[0]
+
+    rounds = max(int(args.rate * args.duration), 1)
+    rng = random.Random(args.seed)
+    crash_round = {key: rng.randint(rounds // 5, max(rounds - 1, rounds // 5)) for key in keys}
+    prices = {key: 100.0 for key in keys}
+    crash_time = {}
+    max_backlog = 0
+
+    started = time.time()
+    for round_number in range(rounds):
+        for key in keys:
+            if round_number == crash_round[key]:
+                # Gap well through any trailed stop
+                prices[key] *= 0.9
+            else:
+                prices[key] = round(prices[key] * (1 + rng.uniform(-0.0002, 0.0003)), 2)
+        publish_time = time.time()
+        exchange.publish(dict(prices))
+        for key in keys:
+            if round_number == crash_round[key]:
+                crash_time[key] = publish_time
+        max_backlog = max(max_backlog, ticker.backlog())
+        next_round = started + (round_number + 1) / args.rate
+        delay = next_round - time.time()
+        if delay > 0:
+            time.sleep(delay)
+    feed_seconds = time.time() - started
+
+    # Let the ticker and order worker drain
+    drain_deadline = time.time() + args.drain
+    exits = []
+    while time.time() < drain_deadline:
+        exits = [order for order in exchange.order_log if (order.get('tag') or '').startswith('slx')]
+        if len(exits) >= len(keys) and ticker.backlog() == 0:
+            break
+        time.sleep(0.05)
+
+    latencies = []
+    for order in exits:
+        key = symbols.get(order.get('tradingsymbol')) or order.get('instrument_token')
+        # An exit placed before the gap (the random walk hit the stop first) has no gap latency
+        if key in crash_time and order['received_at'] >= crash_time[key]:
+            latencies.append((order['received_at'] - crash_time[key]) * 1000)
+
+    manager.stop()
+    target = args.rate * len(keys)
+    return {
+        'broker': broker,
+        'instruments': len(keys),
+        'rate_per_instrument': args.rate,
+        'target_ticks_per_second': target,
+        'achieved_ticks_per_second': rounds * len(keys) / feed_seconds,
+        'max_ticker_backlog_rounds': max_backlog,
+        'exits_expected': len(keys),
+        'exits_placed': len(exits),
+        'exits_rejected': sum(1 for order in exits if order['status'] == 'REJECTED'),
+        'latency_ms_p50': percentile(latencies, 0.50),
+        'latency_ms_p95': percentile(latencies, 0.95),
+        'latency_ms_p99': percentile(latencies, 0.99),
+        'latency_ms_max': max(latencies) if latencies else None,
+    }
+
+def print_result(result):
+    def ms(value):
+        return f"{value:.1f}" if value is not None else "-"
+    print(f"{result['broker']} {result['instruments']} instruments x {result['rate_per_instrument']} ticks/s: "
+          f"{result['achieved_ticks_per_second']:.0f}/{result['target_ticks_per_second']:.0f} ticks/s, "
+          f"backlog {result['max_ticker_backlog_rounds']}, "
+          f"exits {result['exits_placed']}/{result['exits_expected']} ({result['exits_rejected']} rejected), "
+          f"latency ms p50 {ms(result['latency_ms_p50'])} p95 {ms(result['latency_ms_p95'])} "
+          f"p99 {ms(result['latency_ms_p99'])} max {ms(result['latency_ms_max'])}")
+
+def is_saturated(result, max_p99_ms):
+    if result['achieved_ticks_per_second'] < 0.95 * result['target_ticks_per_second']:
+        return True
+    if result['exits_placed'] < result['exits_expected']:
+        return True
+    p99 = result['latency_ms_p99']
+    return p99 is None or p99 > max_p99_ms
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--broker', choices=['Zerodha', 'Upstox'], default='Zerodha')
+    parser.add_argument('--instruments', type=int, default=50)
+    parser.add_argument('--rate', type=float, default=10.0, help='ticks per second per instrument')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds of ticks to stream')
+    parser.add_argument('--drain', type=float, default=10.0, help='seconds to wait for exits after the feed stops')
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='latency added to every fake REST call')
+    parser.add_argument('--rate-limit', type=int, default=None, help='fake REST requests per second')
+    parser.add_argument('--reject-rate', type=float, default=0.0, help='fraction of fake orders rejected')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--sweep', help='comma-separated per-instrument rates to run one after another')
+    parser.add_argument('--max-p99-ms', type=float, default=500.0)
+    parser.add_argument('--json', action='store_true', help='print the result as JSON (used by --sweep)')
+    args = parser.parse_args()
+
+    if not args.sweep:
+        result = run_once(args)
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print_result(result)
+        return 0
+
+    # Each level runs in its own process so threads and the database start clean
+    child_args = [
+        '--broker', args.broker, '--instruments', str(args.instruments), '--duration', str(args.duration),
+        '--drain', str(args.drain), '--latency-ms', str(args.latency_ms), '--reject-rate', str(args.reject_rate),
+        '--seed', str(args.seed), '--json'
+    ]
+    if args.rate_limit is not None:
+        child_args += ['--rate-limit', str(args.rate_limit)]
+    saturated_at = None
+    for rate in (float(value) for value in args.sweep.split(',')):
+        completed = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), *child_args, '--rate', str(rate)],
+            capture_output=True, text=True
+        )
+        if completed.returncode != 0:
+            print(completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else f"rate {rate} failed")
+            return 1
+        result = json.loads(completed.stdout.strip().splitlines()[-1])
+        print_result(result)
+        if saturated_at is None and is_saturated(result, args.max_p99_ms):
+            saturated_at = result['target_ticks_per_second']
+    if saturated_at is None:
+        print("No saturation within the sweep.")
+    else:
+        print(f"Saturation at about {saturated_at:.0f} ticks/s.")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -13,7 +13,10 @@ CREATE TABLE orders (
     exchange TEXT,
     product TEXT,
     broker TEXT NOT NULL,
-    instrument_key TEXT
+    instrument_key TEXT,
+    trail_reference TEXT DEFAULT 'AUTO',
+    atr_multiplier REAL DEFAULT 0,
+    broker_stop_id TEXT
 );
 
 DROP TABLE IF EXISTS instruments;
@@ -35,3 +38,29 @@ DROP TABLE IF EXISTS encryption_key;
 CREATE TABLE encryption_key (
     key BLOB NOT NULL
 );
+
+-- Durable exit outbox. Created with IF NOT EXISTS so init_db can add it to
+-- existing databases without touching the tables above.
+CREATE TABLE IF NOT EXISTS order_outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    order_row_id INTEGER NOT NULL UNIQUE,
+    broker TEXT NOT NULL,
+    tag TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    broker_order_id TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_order_outbox_status ON order_outbox (status);
+
+-- Append-only history of every outbox state change.
+CREATE TABLE IF NOT EXISTS order_outbox_log (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    outbox_id INTEGER NOT NULL,
+    event TEXT NOT NULL,
+    detail TEXT,
+    created_at REAL NOT NULL
+);
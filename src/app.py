@@ -1,22 +1,33 @@
 from flask import Flask, render_template, request, redirect, session, flash, jsonify
-from kiteconnect import KiteConnect
-import upstox_client
 import os
 import time
 import threading
 import logging
 import queue
 from functools import wraps
-from db import get_db_connection, update_instrument_list, init_db
+from db import get_db_connection, update_instrument_list, init_db, ensure_db_initialized
 from websocket_manager import ZerodhaWebSocketManager, UpstoxWebSocketManager
 from security import encrypt_value, decrypt_value
+from brokers import get_kite, upstox_sdk, get_upstox_product, is_definite_rejection
+import outbox
+import stops
+import bars
+import event_store
+import broker_stops
+from bars import BarBuilder
+from broker_stops import BrokerStopManager
+from risk import PortfolioRisk
+from event_store import EventStore
 
 app = Flask(__name__, template_folder='../templates', static_folder='../static')
 app.secret_key = os.urandom(24)
 
 # --- Initialize DB ---
-with app.app_context():
-    init_db()
+# Deferred to the first request (or the order worker, whichever comes first),
+# so importing the app stays fast.
+@app.before_request
+def initialize_on_first_use():
+    ensure_db_initialized()
 
 # --- Logging ---
 logging.basicConfig(filename='app.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -37,13 +48,21 @@ def load_settings_from_db():
         logging.error(f"Could not load settings from database: {e}. Please run the app and configure via /settings.")
         return {}
 
-APP_SETTINGS = load_settings_from_db()
+_app_settings = None
+_app_settings_lock = threading.Lock()
+
+def get_app_settings():
+    """Returns the settings, loading and decrypting them from the database on first use."""
+    global _app_settings
+    if _app_settings is None:
+        with _app_settings_lock:
+            if _app_settings is None:
+                ensure_db_initialized()
+                _app_settings = load_settings_from_db()
+    return _app_settings
 
-ZERODHA_API_KEY = APP_SETTINGS.get("ZERODHA_API_KEY")
-ZERODHA_API_SECRET = APP_SETTINGS.get("ZERODHA_API_SECRET")
-UPSTOX_API_KEY = APP_SETTINGS.get("UPSTOX_API_KEY")
-UPSTOX_API_SECRET = APP_SETTINGS.get("UPSTOX_API_SECRET")
-UPSTOX_REDIRECT_URI = APP_SETTINGS.get("UPSTOX_REDIRECT_URI", "http://localhost:5000/callback/upstox")
+# Settings that are not credentials and can be shown back in the settings form
+NON_SECRET_SETTINGS = ['UPSTOX_REDIRECT_URI', 'BROKER_SIDE_STOPS', 'RISK_MAX_LOSS', 'RISK_MAX_DRAWDOWN', 'RISK_MAX_CAPITAL_AT_RISK']
 
 # --- Global variables for access tokens & websocket managers (simplified for single-user context) ---
 ACCESS_TOKENS = {
@@ -55,13 +74,71 @@ WEBSOCKET_MANAGERS = {
     "upstox": None
 }
 
-# --- Utility Functions ---
-def get_upstox_product(product_str):
-    return {"MIS": "I", "CNC": "D", "NRML": "I"}.get(product_str, "I")
+# --- Live OHLC bars built from the tick stream of every broker ---
+BAR_FLUSH_DIRECTORY = 'bars'
+BAR_FLUSH_INTERVAL_SECONDS = 60
+bar_builder = BarBuilder()
+
+# --- Append-only per-day log of stop moves, triggers and order events ---
+EVENTS_DIRECTORY = 'events'
+events = EventStore(EVENTS_DIRECTORY)
 
-# --- Zerodha Login ---
-# Initialize KiteConnect. It will be updated with the API key from settings.
-kite = KiteConnect(api_key=None)
+def get_broker_api(broker):
+    """Returns the broker's order API client, authenticated with the current access token."""
+    if broker == 'Zerodha':
+        kite = get_kite()
+        kite.set_access_token(ACCESS_TOKENS['zerodha'])
+        return kite
+    upstox_client = upstox_sdk()
+    configuration = upstox_client.Configuration()
+    configuration.access_token = ACCESS_TOKENS['upstox']
+    return upstox_client.OrderApi(upstox_client.ApiClient(configuration))
+
+_broker_stop_manager = None
+_broker_stop_manager_lock = threading.Lock()
+
+def get_broker_stop_manager():
+    """
+    Returns the broker-side stop manager, starting it on first use. It only places
+    and trails stops at the broker (with the local engine as a backstop) when
+    broker-side stops are enabled in settings, but it is always there to cancel
+    stops left over from a run with them enabled.
+    """
+    global _broker_stop_manager
+    if _broker_stop_manager is None:
+        with _broker_stop_manager_lock:
+            if _broker_stop_manager is None:
+                enabled = get_app_settings().get("BROKER_SIDE_STOPS") == "on"
+                _broker_stop_manager = BrokerStopManager(get_broker_api, enabled=enabled)
+                _broker_stop_manager.start()
+    return _broker_stop_manager
+
+def exit_all_positions(reason):
+    """Portfolio kill switch: queues exits for every open position of every broker."""
+    for manager in WEBSOCKET_MANAGERS.values():
+        if manager:
+            manager.exit_all(reason)
+
+def _risk_limit(key):
+    value = get_app_settings().get(key)
+    return float(value) if value else None
+
+_portfolio_risk = None
+_portfolio_risk_lock = threading.Lock()
+
+def get_portfolio_risk():
+    """Returns the portfolio risk aggregator shared by all brokers, with kill-switch limits from settings."""
+    global _portfolio_risk
+    if _portfolio_risk is None:
+        with _portfolio_risk_lock:
+            if _portfolio_risk is None:
+                _portfolio_risk = PortfolioRisk(
+                    max_loss=_risk_limit('RISK_MAX_LOSS'),
+                    max_drawdown=_risk_limit('RISK_MAX_DRAWDOWN'),
+                    max_capital_at_risk=_risk_limit('RISK_MAX_CAPITAL_AT_RISK'),
+                    on_breach=exit_all_positions
+                )
+    return _portfolio_risk
 
 # --- Settings Management ---
 def get_all_settings():
@@ -75,10 +152,10 @@ def get_all_settings():
         decrypted_value = decrypt_value(row['value'])
         if decrypted_value:
             settings[row['key']] = "********" # Placeholder for UI
-    # Also get the non-secret redirect URI
-    redirect_uri_row = next((r for r in settings_from_db if r['key'] == 'UPSTOX_REDIRECT_URI'), None)
-    if redirect_uri_row:
-        settings['UPSTOX_REDIRECT_URI'] = decrypt_value(redirect_uri_row['value'])
+    # Also get the non-secret values, like the redirect URI
+    for row in settings_from_db:
+        if row['key'] in NON_SECRET_SETTINGS:
+            settings[row['key']] = decrypt_value(row['value'])
 
     return settings
 
@@ -92,48 +169,121 @@ def save_setting(key, value):
     conn.commit()
     conn.close()
 
+def save_optional_setting(key, value):
+    """Like save_setting, but a blank value removes the setting, e.g. to turn a kill-switch limit off."""
+    if value:
+        save_setting(key, value)
+        return
+    conn = get_db_connection()
+    conn.execute('DELETE FROM settings WHERE key = ?', (key,))
+    conn.commit()
+    conn.close()
+
 # --- Order Queue for Thread-Safe Order Placement ---
+# The queue only carries outbox ids; the exit orders themselves live in the
+# durable order_outbox table so they survive a restart.
 order_queue = queue.Queue()
 
+def find_exit_order_by_tag(broker, tag):
+    """Returns the broker order id of an already placed exit with this tag, if any."""
+    if broker == 'Zerodha':
+        for order in get_broker_api(broker).orders():
+            if order.get('tag') == tag:
+                return order['order_id']
+    elif broker == 'Upstox':
+        api_response = get_broker_api(broker).get_order_book(api_version="v2")
+        for order in api_response.data or []:
+            if order.tag == tag:
+                return order.order_id
+    return None
+
+def dispatch_pending_exits(broker=None):
+    """Puts every pending outbox entry (optionally for one broker) on the order queue."""
+    for outbox_id in outbox.pending_exit_ids(broker):
+        order_queue.put(outbox_id)
+
+def retry_exit_later(outbox_id, attempts, error):
+    """
+    Returns a failed exit to PENDING and re-queues it after a backoff. The order
+    may have reached the broker anyway (e.g. on a timeout), so the retry looks
+    for its tag before placing again.
+    """
+    delay = outbox.retry_delay(attempts)
+    if delay is None:
+        outbox.release(outbox_id, f"attempt {attempts} failed: {error}; retrying at next login or restart")
+        return
+    outbox.release(outbox_id, f"attempt {attempts} failed: {error}; retrying in {delay:.0f}s")
+    timer = threading.Timer(delay, order_queue.put, args=(outbox_id,))
+    timer.daemon = True
+    timer.start()
+
 def order_placement_worker():
-    """This worker runs in a background thread to place orders from the queue."""
+    """This worker runs in a background thread to place orders from the outbox."""
+    # Re-dispatch exits that were triggered but not placed before the last shutdown.
+    # Done here rather than at import so startup is not blocked on the database.
+    ensure_db_initialized()
+    outbox.recover_pending_exits()
+    dispatch_pending_exits()
+
     while True:
-        order_details = order_queue.get()
-        if order_details is None: # A way to stop the worker
+        outbox_id = order_queue.get()
+        if outbox_id is None: # A way to stop the worker
             break
 
-        broker = order_details['broker']
-        logging.info(f"Worker picked up a {broker} order for {order_details['symbol']}.")
-
+        claimed = None
         try:
+            claimed = outbox.claim(outbox_id)
+            if claimed is None:
+                # Already handled, e.g. dispatched twice by recovery and login.
+                continue
+            order_details, attempts = claimed
+            broker = order_details['broker']
+            tag = order_details['tag']
+            logging.info(f"Worker picked up a {broker} order for {order_details['symbol']} (attempt {attempts}).")
+
+            if not ACCESS_TOKENS.get(broker.lower()):
+                logging.error(f"{broker} access token not found for order placement. Exit stays pending until login.")
+                outbox.release(outbox_id, 'no access token')
+                continue
+
+            # A previous attempt may have reached the broker before the process died.
+            if attempts > 1:
+                existing_order_id = find_exit_order_by_tag(broker, tag)
+                if existing_order_id:
+                    logging.info(f"Exit for {order_details['symbol']} already placed as {existing_order_id}; not placing again.")
+                    outbox.mark_done(outbox_id, order_details['order_id'], existing_order_id)
+                    continue
+
+            # Take the broker-side stop down first, even if broker-side stops have
+            # since been turned off. A market exit on top of a stop that already
+            # filled would double up; one whose fate is unknown is retried.
+            stop_state = get_broker_stop_manager().cancel(order_details['order_id'], broker)
+            if stop_state == broker_stops.STOP_FILLED:
+                logging.info(f"Broker-side stop for {order_details['symbol']} already filled; skipping local exit.")
+                outbox.mark_done(outbox_id, order_details['order_id'])
+                continue
+            if stop_state == broker_stops.STOP_UNRESOLVED:
+                retry_exit_later(outbox_id, attempts, 'broker-side stop could not be cancelled')
+                continue
+
             # Use app_context to be able to access session and other context-bound objects
             # if needed in the future, though not strictly necessary for this implementation.
             with app.app_context():
+                broker_order_id = None
                 if broker == 'Zerodha':
-                    access_token = ACCESS_TOKENS.get('zerodha')
-                    if not access_token:
-                        logging.error("Zerodha access token not found for order placement.")
-                        continue
-                    kite.set_access_token(access_token)
-                    kite.place_order(
+                    broker_order_id = get_broker_api(broker).place_order(
                         variety="regular", exchange=order_details['exchange'],
                         tradingsymbol=order_details['symbol'],
                         transaction_type=order_details['transaction_type'],
                         quantity=order_details['quantity'],
                         product=order_details['product'],
-                        order_type='MARKET'
+                        order_type='MARKET',
+                        tag=tag
                     )
                 elif broker == 'Upstox':
-                    access_token = ACCESS_TOKENS.get('upstox')
-                    if not access_token:
-                        logging.error("Upstox access token not found for order placement.")
-                        continue
-
-                    configuration = upstox_client.Configuration()
-                    configuration.access_token = access_token
-                    api_instance = upstox_client.OrderApi(upstox_client.ApiClient(configuration))
+                    api_instance = get_broker_api(broker)
 
-                    v3_request_body = upstox_client.PlaceOrderRequest(
+                    v3_request_body = upstox_sdk().PlaceOrderRequest(
                         quantity=order_details['quantity'],
                         product=get_upstox_product(order_details['product']),
                         validity="DAY",
@@ -143,27 +293,46 @@ def order_placement_worker():
                         price=0,
                         disclosed_quantity=0,
                         trigger_price=0,
-                        is_amo=False
+                        is_amo=False,
+                        tag=tag
                     )
 
-                    api_instance.place_order(
+                    api_response = api_instance.place_order(
                         api_version="v3",
                         body=v3_request_body
                     )
+                    if api_response.data.order_ids:
+                        broker_order_id = api_response.data.order_ids[0]
 
                 logging.info(f"Stop-loss order placed successfully for {order_details['symbol']}.")
+                events.record(event_store.ORDER_PLACED, order_details['instrument_key'], order_details['order_id'],
+                              aux=attempts)
 
-                # Update the order status in the database to prevent re-triggering
-                conn = get_db_connection()
-                conn.execute('UPDATE orders SET status = ? WHERE id = ?', ('CLOSED', order_details['order_id']))
-                conn.commit()
-                conn.close()
+                # Close the local order to prevent re-triggering
+                outbox.mark_done(outbox_id, order_details['order_id'], broker_order_id)
 
         except Exception as e:
             logging.error(f"Error placing stop-loss order from worker: {e}")
+            # Nothing to release if the claim itself failed
+            if claimed is not None:
+                events.record(event_store.ORDER_FAILED, order_details['instrument_key'], order_details['order_id'],
+                              aux=attempts)
+                if is_definite_rejection(e):
+                    outbox.mark_failed(outbox_id, order_details['order_id'], e)
+                else:
+                    retry_exit_later(outbox_id, attempts, e)
         finally:
             order_queue.task_done()
 
+def bar_flush_worker():
+    """Periodically writes closed bars to disk so the 1s ring buffer does not lose history."""
+    while True:
+        time.sleep(BAR_FLUSH_INTERVAL_SECONDS)
+        try:
+            bar_builder.flush_to_disk(BAR_FLUSH_DIRECTORY)
+        except Exception as e:
+            logging.error(f"Error flushing bars to disk: {e}")
+
 # --- Decorators ---
 def login_required(f):
     @wraps(f)
@@ -191,8 +360,9 @@ def init_db_route():
 
 @app.route('/login/zerodha')
 def login_zerodha():
+    kite = get_kite()
     # Dynamically update the api_key before generating the login URL
-    kite.api_key = APP_SETTINGS.get("ZERODHA_API_KEY")
+    kite.api_key = get_app_settings().get("ZERODHA_API_KEY")
     if not kite.api_key:
         flash("Zerodha API Key is not configured. Please configure it in Settings.", "error")
         return redirect('/settings')
@@ -200,10 +370,11 @@ def login_zerodha():
 
 @app.route('/callback/zerodha')
 def callback_zerodha():
+    kite = get_kite()
     request_token = request.args.get('request_token')
     try:
         # Use the globally loaded secret key
-        api_secret = APP_SETTINGS.get("ZERODHA_API_SECRET")
+        api_secret = get_app_settings().get("ZERODHA_API_SECRET")
         if not api_secret:
             flash("Zerodha API Secret is not configured.", "error")
             return redirect('/settings')
@@ -221,9 +392,14 @@ def callback_zerodha():
             access_token=access_token,
             order_queue=order_queue,
             api_key=kite.api_key,
-            broker_api=kite
+            broker_api=kite,
+            bar_builder=bar_builder,
+            broker_stops=get_broker_stop_manager(),
+            risk=get_portfolio_risk(),
+            events=events
         )
         WEBSOCKET_MANAGERS['zerodha'].start()
+        dispatch_pending_exits('Zerodha')
 
         kite.set_access_token(access_token)
         message = update_instrument_list('Zerodha', kite)
@@ -236,8 +412,8 @@ def callback_zerodha():
 
 @app.route('/login/upstox')
 def login_upstox():
-    api_key = APP_SETTINGS.get("UPSTOX_API_KEY")
-    redirect_uri = APP_SETTINGS.get("UPSTOX_REDIRECT_URI")
+    api_key = get_app_settings().get("UPSTOX_API_KEY")
+    redirect_uri = get_app_settings().get("UPSTOX_REDIRECT_URI")
     if not api_key or not redirect_uri:
         flash("Upstox API Key or Redirect URI is not configured. Please configure it in Settings.", "error")
         return redirect('/settings')
@@ -246,12 +422,13 @@ def login_upstox():
 
 @app.route('/callback/upstox')
 def callback_upstox():
+    upstox_client = upstox_sdk()
     code = request.args.get('code')
     api_instance = upstox_client.LoginApi()
     try:
-        api_key = APP_SETTINGS.get("UPSTOX_API_KEY")
-        api_secret = APP_SETTINGS.get("UPSTOX_API_SECRET")
-        redirect_uri = APP_SETTINGS.get("UPSTOX_REDIRECT_URI")
+        api_key = get_app_settings().get("UPSTOX_API_KEY")
+        api_secret = get_app_settings().get("UPSTOX_API_SECRET")
+        redirect_uri = get_app_settings().get("UPSTOX_REDIRECT_URI")
 
         if not all([api_key, api_secret, redirect_uri]):
             flash("Upstox API settings are not fully configured.", "error")
@@ -282,9 +459,14 @@ def callback_upstox():
             broker='Upstox',
             access_token=access_token,
             order_queue=order_queue,
-            broker_api=upstox_order_api
+            broker_api=upstox_order_api,
+            bar_builder=bar_builder,
+            broker_stops=get_broker_stop_manager(),
+            risk=get_portfolio_risk(),
+            events=events
         )
         WEBSOCKET_MANAGERS['upstox'].start()
+        dispatch_pending_exits('Upstox')
 
         message = update_instrument_list('Upstox', kite_instance=None)
         flash(message, "info")
@@ -315,6 +497,7 @@ def place_order():
 
     try:
         if broker == 'Zerodha':
+            kite = get_kite()
             kite.set_access_token(ACCESS_TOKENS['zerodha'])
             order_id = kite.place_order(
                 variety="regular", exchange=request.form['exchange'],
@@ -333,6 +516,7 @@ def place_order():
                 return redirect('/')
             instrument_token = instrument['instrument_key']
 
+            upstox_client = upstox_sdk()
             configuration = upstox_client.Configuration()
             configuration.access_token = ACCESS_TOKENS['upstox']
             api_instance = upstox_client.OrderApi(upstox_client.ApiClient(configuration))
@@ -366,14 +550,23 @@ def place_order():
 
         price = float(request.form['price'] or 0)
         stoploss_percent = float(request.form['stoploss'])
-        initial_stoploss_price = price * (1 - stoploss_percent / 100) if price > 0 else 0
-
-        conn.execute(
-            'INSERT INTO orders (order_id, symbol, quantity, price, initial_stoploss, current_stoploss_price, status, broker, transaction_type, exchange, product, instrument_key) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
-            (order_id, request.form['symbol'], int(request.form['quantity']), price, stoploss_percent, initial_stoploss_price, 'OPEN', broker, request.form['transaction_type'], request.form['exchange'], request.form['product'], instrument_key_to_store)
+        initial_stoploss_price = stops.initial_stop(stops.is_long(request.form['transaction_type']), price, stoploss_percent)
+        trail_reference = request.form.get('trail_reference', stops.REFERENCE_AUTO)
+        if trail_reference not in stops.REFERENCES:
+            trail_reference = stops.REFERENCE_AUTO
+        atr_multiplier = float(request.form.get('atr_multiplier') or 0)
+
+        cursor = conn.execute(
+            'INSERT INTO orders (order_id, symbol, quantity, price, initial_stoploss, current_stoploss_price, status, broker, transaction_type, exchange, product, instrument_key, trail_reference, atr_multiplier) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (order_id, request.form['symbol'], int(request.form['quantity']), price, stoploss_percent, initial_stoploss_price, 'OPEN', broker, request.form['transaction_type'], request.form['exchange'], request.form['product'], instrument_key_to_store, trail_reference, atr_multiplier)
         )
         conn.commit()
 
+        # Placed at the broker once the entry fills
+        if initial_stoploss_price > 0:
+            new_order = conn.execute('SELECT * FROM orders WHERE id = ?', (cursor.lastrowid,)).fetchone()
+            get_broker_stop_manager().request(new_order, initial_stoploss_price, price)
+
         # Subscribe to the instrument's ticks
         ws_manager = WEBSOCKET_MANAGERS.get(broker.lower())
         if ws_manager:
@@ -387,6 +580,23 @@ def place_order():
     conn.close()
     return redirect('/')
 
+@app.route('/orders/<int:order_row_id>/rearm', methods=['POST'])
+@login_required
+def rearm_order(order_row_id):
+    """Puts a position whose exit the broker refused back under its trailing stop."""
+    if outbox.rearm(order_row_id):
+        get_portfolio_risk().restore(order_row_id)
+        conn = get_db_connection()
+        order = conn.execute('SELECT broker, instrument_key FROM orders WHERE id = ?', (order_row_id,)).fetchone()
+        conn.close()
+        ws_manager = WEBSOCKET_MANAGERS.get(order['broker'].lower())
+        if ws_manager:
+            ws_manager.subscribe([order['instrument_key']])
+        flash("Stop-loss re-armed. The position exits again if its stop is hit.", "success")
+    else:
+        flash("Only orders whose exit failed can be re-armed.", "error")
+    return redirect('/')
+
 @app.route('/update_instruments')
 @login_required
 def update_instruments_route():
@@ -398,8 +608,8 @@ def update_instruments_route():
         if not access_token:
             flash("Zerodha session expired. Please login again.", "error")
             return redirect('/login/zerodha')
-        kite.set_access_token(access_token)
-        kite_instance = kite
+        kite_instance = get_kite()
+        kite_instance.set_access_token(access_token)
 
     message = update_instrument_list(broker, kite_instance)
     flash(message, "info")
@@ -422,6 +632,10 @@ def settings():
         save_setting('UPSTOX_API_KEY', request.form.get('upstox_api_key'))
         save_setting('UPSTOX_API_SECRET', request.form.get('upstox_api_secret'))
         save_setting('UPSTOX_REDIRECT_URI', request.form.get('upstox_redirect_uri'))
+        save_setting('BROKER_SIDE_STOPS', request.form.get('broker_side_stops'))
+        save_optional_setting('RISK_MAX_LOSS', request.form.get('risk_max_loss'))
+        save_optional_setting('RISK_MAX_DRAWDOWN', request.form.get('risk_max_drawdown'))
+        save_optional_setting('RISK_MAX_CAPITAL_AT_RISK', request.form.get('risk_max_capital_at_risk'))
 
         flash("Settings saved successfully. Please restart the application for changes to take effect.", "success")
         return redirect('/settings')
@@ -441,6 +655,43 @@ def api_symbols():
     conn.close()
     return jsonify([s['trading_symbol'] for s in symbols])
 
+@app.route('/api/bars/<path:instrument_key>')
+@login_required_api
+def api_bars(instrument_key):
+    interval = request.args.get('interval', '1m')
+    limit = request.args.get('limit', type=int)
+    try:
+        instrument_bars = bar_builder.get_bars(instrument_key, interval, limit)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(instrument_bars)
+
+@app.route('/api/events/<path:instrument_key>')
+@login_required_api
+def api_events(instrument_key):
+    day = request.args.get('day')
+    kind = request.args.get('kind')
+    kinds = None
+    if kind:
+        kinds = {code for code, name in event_store.KIND_NAMES.items() if name == kind.upper()}
+        if not kinds:
+            return jsonify({"error": f"Unknown event kind '{kind}'"}), 400
+    try:
+        return jsonify(events.query_rows(instrument_key, day, kinds))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+@app.route('/api/risk')
+@login_required_api
+def api_risk():
+    return jsonify(get_portfolio_risk().snapshot())
+
+@app.route('/api/risk/reset', methods=['POST'])
+@login_required_api
+def api_risk_reset():
+    get_portfolio_risk().reset()
+    return jsonify(get_portfolio_risk().snapshot())
+
 @app.route('/shutdown')
 def shutdown():
     shutdown_func = request.environ.get('werkzeug.server.shutdown')
@@ -455,6 +706,11 @@ def shutdown():
 
     # Stop the order placement worker
     order_queue.put(None)
+    if _broker_stop_manager is not None:
+        _broker_stop_manager.stop()
+
+    bar_builder.flush_to_disk(BAR_FLUSH_DIRECTORY)
+    events.stop()
 
     shutdown_func()
     return "Server shutting down..."
@@ -462,6 +718,11 @@ def shutdown():
 # Start the background worker thread for order placement
 order_worker_thread = threading.Thread(target=order_placement_worker, daemon=True)
 order_worker_thread.start()
+events.start()
+
+if bars.numpy_available():
+    bar_flush_thread = threading.Thread(target=bar_flush_worker, daemon=True)
+    bar_flush_thread.start()
 
 if __name__ == '__main__':
     app.run(debug=True, port=5000)
\ No newline at end of file
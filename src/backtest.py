@@ -0,0 +1,452 @@
+"""
+Offline backtest of the trailing stop-loss rules over historical data.
+
+Opens one position per file at its first price and runs it through the same
+rules as the live tick handler (stops.py) for every combination of side,
+trailing reference, stop-loss percent and ATR multiplier, across a process
+pool with one file per task.
+
+    python src/backtest.py data/ --percents 0.5,1,2,3 --references LTP,TOUCH --sides BUY,SELL
+
+Input files, one symbol each (the file name is the symbol), or segments:
+  - CSV candles with open, high, low and close columns. A bar triggers when its
+    low (high for shorts) reaches the stop set by the previous bars, and exits
+    at the stop, or at the open if the bar gapped through it. The stop trails
+    on the close. Candles have no order book, so every reference trails on the
+    close.
+  - CSV ticks with an ltp (or price) column and optional bid and ask columns.
+    These are run exactly like live ticks.
+  - .npy bar segments written by BarBuilder.flush_to_disk, named
+    <instrument>_<interval>_<start>.npy. The segments of one instrument and
+    interval are joined in start order into one series named
+    <instrument>_<interval>; --interval keeps only one interval.
+
+A timestamp, time or date column (epoch seconds or ISO format) is carried
+through to the exit time. ATR multipliers use the live definition, the
+1-minute true-range ATR of stops.VolatilityTracker: tick files feed it by
+timestamp and candle files must be 1-minute candles, which are its bars.
+Files that cannot match it are refused when a non-zero multiplier is asked
+for. With NumPy installed, each file's parameter grid is simulated at once using running
+maxima/minima of the candidate stop; without it (or with --scalar) every
+combination is stepped through the stops.py functions one row at a time.
+"""
+import argparse
+import csv
+import os
+import re
+import sys
+import logging
+import statistics
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import numpy as np
+except ImportError:  # The scalar simulation does not need it
+    np = None
+
+import stops
+from bars import BAR_FIELDS
+
+KIND_OHLC = 'OHLC'
+KIND_TICK = 'TICK'
+
+TIME_COLUMNS = ('timestamp', 'time', 'date', 'start')
+
+# BarBuilder.flush_to_disk names segments <instrument>_<interval>_<start>.npy
+SEGMENT_NAME = re.compile(r'^(?P<series>.+_(?P<interval>[^_]+))_(?P<start>\d+)\.npy$')
+
+# Upper bound on parameter rows x series length per NumPy chunk, to cap memory
+MAX_CELLS_PER_CHUNK = 2_000_000
+
+RESULT_FIELDS = ('symbol', 'kind', 'side', 'reference', 'stoploss_percent', 'atr_multiplier', 'entry_price',
+                 'exit_price', 'exit_time', 'rows_held', 'hit', 'pnl_percent', 'locked_profit_percent')
+
+def _float_or_none(value):
+    return float(value) if value not in (None, '') else None
+
+def source_name(source):
+    """The symbol of a source: a file name, or <instrument>_<interval> for a group of .npy segments."""
+    path = source[0] if isinstance(source, (list, tuple)) else source
+    match = SEGMENT_NAME.match(os.path.basename(path))
+    if match:
+        return match.group('series')
+    return os.path.splitext(os.path.basename(path))[0]
+
+def _segment_start(path):
+    match = SEGMENT_NAME.match(os.path.basename(path))
+    return int(match.group('start')) if match else 0
+
+def load_series(source):
+    """
+    Reads one historical file, or a list of .npy segments of the same series, and
+    returns (symbol, kind, columns), columns being a dict of lists.
+    """
+    symbol = source_name(source)
+    segments = source if isinstance(source, (list, tuple)) else [source] if source.endswith('.npy') else None
+
+    if segments is not None:
+        if np is None:
+            raise ValueError(f"{symbol}: reading .npy bar segments requires numpy")
+        data = np.concatenate([np.load(path) for path in sorted(segments, key=_segment_start)])
+        columns = {field: data[:, i].tolist() for i, field in enumerate(BAR_FIELDS)}
+        columns['time'] = columns.pop('start')
+        return symbol, KIND_OHLC, columns
+
+    path = source
+
+    with open(path, newline='') as f:
+        rows = list(csv.DictReader(f))
+    if not rows:
+        raise ValueError(f"{path}: no rows")
+    header = {name.strip().lower(): name for name in rows[0].keys()}
+    time_column = next((header[name] for name in TIME_COLUMNS if name in header), None)
+    columns = {'time': [row[time_column] for row in rows] if time_column else [None] * len(rows)}
+
+    if all(name in header for name in ('open', 'high', 'low', 'close')):
+        for name in ('open', 'high', 'low', 'close'):
+            columns[name] = [float(row[header[name]]) for row in rows]
+        return symbol, KIND_OHLC, columns
+
+    price_column = header.get('ltp') or header.get('price')
+    if price_column is None:
+        raise ValueError(f"{path}: expected open/high/low/close or ltp columns")
+    columns['ltp'] = [float(row[price_column]) for row in rows]
+    for name in ('bid', 'ask'):
+        columns[name] = [_float_or_none(row[header[name]]) for row in rows] if name in header else [None] * len(rows)
+    return symbol, KIND_TICK, columns
+
+def _timestamp(value):
+    """Epoch seconds from a number or an ISO date/time string, or None."""
+    if value is None or value == '':
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return datetime.fromisoformat(str(value)).timestamp()
+    except ValueError:
+        return None
+
+def atr_series(kind, columns):
+    """
+    The ATR each row's trailing step sees live: the VolatilityTracker value as of
+    the last closed 1-minute bar, 0 until warm. Candles are those bars, so a
+    candle's own range only counts from the next candle on. Raises ValueError if
+    the file has no usable timestamps or its candles are not 1-minute.
+    """
+    timestamps = [_timestamp(value) for value in columns['time']]
+    if None in timestamps:
+        raise ValueError("ATR multipliers need a timestamp on every row")
+    tracker = stops.VolatilityTracker()
+    series = []
+    if kind == KIND_OHLC:
+        if len(timestamps) > 1:
+            interval = statistics.median(b - a for a, b in zip(timestamps, timestamps[1:]))
+            if interval != tracker.bar_seconds:
+                raise ValueError(f"ATR multipliers need {tracker.bar_seconds}s candles to match the live ATR, "
+                                 f"not {interval:g}s")
+        for high, low, close in zip(columns['high'], columns['low'], columns['close']):
+            series.append(tracker.atr if tracker.is_warm else 0.0)
+            tracker.update_bar(high, low, close)
+        return series
+    for price, timestamp in zip(columns['ltp'], timestamps):
+        atr = tracker.update(price, timestamp)
+        series.append(atr if tracker.is_warm else 0.0)
+    return series
+
+def simulate(kind, columns, atr, long_position, stoploss_percent, reference, atr_multiplier, product):
+    """
+    Steps one position through the series with the live rules.
+    Returns (exit_index, exit_price, stop_at_exit); exit_index is None if the stop was never hit.
+    """
+    trailing_prices = columns['close'] if kind == KIND_OHLC else columns['ltp']
+    entry_price = columns['open'][0] if kind == KIND_OHLC else trailing_prices[0]
+    stop = stops.initial_stop(long_position, entry_price, stoploss_percent)
+
+    for i in range(len(trailing_prices)):
+        if kind == KIND_OHLC:
+            adverse = columns['low'][i] if long_position else columns['high'][i]
+            if stops.is_triggered(long_position, adverse, stop):
+                bar_open = columns['open'][i]
+                return i, (min(bar_open, stop) if long_position else max(bar_open, stop)), stop
+            reference_price = trailing_prices[i]
+        else:
+            ltp = trailing_prices[i]
+            if stops.is_triggered(long_position, ltp, stop):
+                return i, ltp, stop
+            reference_price = stops.select_reference_price(
+                reference, product, long_position, ltp, columns['bid'][i], columns['ask'][i]
+            )
+        distance = stops.stop_distance(reference_price, stoploss_percent, atr[i], atr_multiplier)
+        new_stop = stops.trail(long_position, reference_price, stop, distance)
+        if new_stop is not None:
+            stop = new_stop
+
+    return None, trailing_prices[-1], stop
+
+def _reference_array(kind, arrays, long_position, reference, product):
+    """NumPy version of stops.select_reference_price over a whole series (no depth in files, so DEPTH is LTP)."""
+    if kind == KIND_OHLC:
+        return arrays['close']
+    ltp, bid, ask = arrays['ltp'], arrays['bid'], arrays['ask']
+    if reference == stops.REFERENCE_AUTO:
+        reference = stops.REFERENCE_TOUCH if product in stops.INTRADAY_PRODUCTS else stops.REFERENCE_LTP
+    if reference == stops.REFERENCE_TOUCH:
+        touch = bid if long_position else ask
+        return np.where(np.isnan(touch), ltp, touch)
+    if reference == stops.REFERENCE_MID:
+        return np.where(np.isnan(bid) | np.isnan(ask), ltp, (bid + ask) / 2)
+    return ltp
+
+def simulate_vectorized(kind, arrays, atr, long_position, reference, product, percents, multipliers):
+    """
+    Runs many (stop-loss percent, ATR multiplier) pairs over one series at once.
+    A long's stop only ever ratchets up, so after each row it is the running
+    maximum of the initial stop and every candidate so far (minimum for
+    shorts). The stop a row is checked against is the one after the previous
+    row, and the first row that reaches it is the exit, exactly as in simulate().
+    Returns arrays (exit_index or -1, exit_price, stop_at_exit).
+    """
+    trailing_prices = arrays['close'] if kind == KIND_OHLC else arrays['ltp']
+    entry_price = arrays['open'][0] if kind == KIND_OHLC else trailing_prices[0]
+    reference_prices = _reference_array(kind, arrays, long_position, reference, product)
+    percent = percents[:, None]
+
+    distance = np.maximum(reference_prices * percent / 100, atr * multipliers[:, None])
+    if entry_price <= 0:
+        initial = np.zeros(len(percents))
+    elif long_position:
+        initial = entry_price * (1 - percents / 100)
+    else:
+        initial = entry_price * (1 + percents / 100)
+
+    if long_position:
+        after = np.maximum(np.maximum.accumulate(reference_prices - distance, axis=1), initial[:, None])
+    else:
+        # A short's stop of 0 is unset, so the first candidate replaces it
+        unset = np.where(initial > 0, initial, np.inf)
+        after = np.minimum(np.minimum.accumulate(reference_prices + distance, axis=1), unset[:, None])
+    before = np.concatenate([initial[:, None], after[:, :-1]], axis=1)
+
+    if kind == KIND_OHLC:
+        adverse = arrays['low'] if long_position else arrays['high']
+    else:
+        adverse = trailing_prices
+    hit = ((adverse <= before) if long_position else (adverse >= before)) & (before > 0)
+
+    rows = np.arange(len(percents))
+    any_hit = hit.any(axis=1)
+    first = np.where(any_hit, hit.argmax(axis=1), -1)
+    stop_at_exit = np.where(any_hit, before[rows, np.maximum(first, 0)], after[:, -1])
+    if kind == KIND_OHLC:
+        bar_open = arrays['open'][np.maximum(first, 0)]
+        gapped = np.minimum(bar_open, stop_at_exit) if long_position else np.maximum(bar_open, stop_at_exit)
+        exit_price = np.where(any_hit, gapped, trailing_prices[-1])
+    else:
+        exit_price = np.where(any_hit, trailing_prices[np.maximum(first, 0)], trailing_prices[-1])
+    return first, exit_price, stop_at_exit
+
+def _result(symbol, kind, columns, side, reference, stoploss_percent, atr_multiplier, entry_price,
+            exit_index, exit_price, stop_at_exit):
+    long_position = stops.is_long(side)
+    hit = exit_index is not None
+    last = len(columns['time']) - 1
+    return {
+        'symbol': symbol,
+        'kind': kind,
+        'side': side,
+        'reference': reference,
+        'stoploss_percent': stoploss_percent,
+        'atr_multiplier': atr_multiplier,
+        'entry_price': entry_price,
+        'exit_price': exit_price,
+        'exit_time': columns['time'][exit_index if hit else last],
+        'rows_held': (exit_index if hit else last) + 1,
+        'hit': hit,
+        'pnl_percent': stops.locked_profit_percent(long_position, entry_price, exit_price),
+        'locked_profit_percent': stops.locked_profit_percent(long_position, entry_price, stop_at_exit),
+    }
+
+def backtest_file(source, sides, references, percents, multipliers, product='CNC', scalar=False):
+    """
+    Runs the whole parameter grid over one file or group of segments (see
+    load_series). Top-level so process pool workers can pickle it.
+    """
+    symbol, kind, columns = load_series(source)
+    trailing_prices = columns['close'] if kind == KIND_OHLC else columns['ltp']
+    entry_price = columns['open'][0] if kind == KIND_OHLC else trailing_prices[0]
+    if any(multipliers):
+        try:
+            atr = atr_series(kind, columns)
+        except ValueError as e:
+            raise ValueError(f"{symbol}: {e}")
+    else:
+        atr = [0.0] * len(trailing_prices)
+    pairs = [(percent, multiplier) for percent in percents for multiplier in multipliers]
+    results = []
+
+    if scalar or np is None:
+        for side in sides:
+            for reference in references:
+                for percent, multiplier in pairs:
+                    exit_index, exit_price, stop_at_exit = simulate(
+                        kind, columns, atr, stops.is_long(side), percent, reference, multiplier, product
+                    )
+                    results.append(_result(symbol, kind, columns, side, reference, percent, multiplier,
+                                           entry_price, exit_index, exit_price, stop_at_exit))
+        return results
+
+    # Missing bid/ask become NaN, which _reference_array treats like None
+    arrays = {name: np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+              for name, values in columns.items() if name != 'time'}
+    atr_array = np.array(atr, dtype=np.float64)
+    chunk = max(1, MAX_CELLS_PER_CHUNK // len(trailing_prices))
+
+    for side in sides:
+        for reference in references:
+            for start in range(0, len(pairs), chunk):
+                block = pairs[start:start + chunk]
+                first, exit_prices, stops_at_exit = simulate_vectorized(
+                    kind, arrays, atr_array, stops.is_long(side), reference, product,
+                    np.array([p for p, _ in block], dtype=np.float64), np.array([m for _, m in block], dtype=np.float64)
+                )
+                for (percent, multiplier), exit_index, exit_price, stop_at_exit in zip(
+                        block, first.tolist(), exit_prices.tolist(), stops_at_exit.tolist()):
+                    results.append(_result(symbol, kind, columns, side, reference, percent, multiplier, entry_price,
+                                           exit_index if exit_index >= 0 else None, exit_price, stop_at_exit))
+    return results
+
+def find_files(paths, interval=None):
+    """
+    Expands directories into the .csv and .npy files directly inside them and
+    returns the sources to backtest: each CSV path on its own, and the .npy
+    segments of each <instrument>_<interval> as one tuple, wherever they were
+    found. `interval` (e.g. '1m') keeps only the segments of that interval.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(os.path.join(path, name) for name in os.listdir(path)
+                                if name.endswith(('.csv', '.npy'))))
+        else:
+            files.append(path)
+
+    sources = []
+    groups = {}
+    for path in files:
+        match = SEGMENT_NAME.match(os.path.basename(path))
+        if match is None:
+            sources.append(path)
+        elif interval is None or match.group('interval') == interval:
+            segments = groups.get(match.group('series'))
+            if segments is None:
+                segments = groups[match.group('series')] = []
+                sources.append(segments)
+            segments.append(path)
+    # Tuples, so sources can key the futures below
+    return [tuple(source) if isinstance(source, list) else source for source in sources]
+
+def run_backtest(paths, sides, references, percents, multipliers, product='CNC', workers=None, scalar=False,
+                 interval=None):
+    """Backtests every source over the parameter grid, one source per pool task. workers=1 runs in this process."""
+    sources = find_files(paths, interval)
+    arguments = (sides, references, percents, multipliers, product, scalar)
+    results = []
+    if workers == 1:
+        for source in sources:
+            try:
+                results.extend(backtest_file(source, *arguments))
+            except Exception as e:
+                logging.error(f"Backtest of {source_name(source)} failed: {e}")
+        return results
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {source: executor.submit(backtest_file, source, *arguments) for source in sources}
+        for source, future in futures.items():
+            try:
+                results.extend(future.result())
+            except Exception as e:
+                logging.error(f"Backtest of {source_name(source)} failed: {e}")
+    return results
+
+def summarize(results):
+    """One row per parameter combination across all symbols: hit rate and average exit and locked-in profit."""
+    groups = {}
+    for result in results:
+        key = (result['side'], result['reference'], result['stoploss_percent'], result['atr_multiplier'])
+        groups.setdefault(key, []).append(result)
+    summary = []
+    for (side, reference, percent, multiplier), group in groups.items():
+        runs = len(group)
+        summary.append({
+            'side': side,
+            'reference': reference,
+            'stoploss_percent': percent,
+            'atr_multiplier': multiplier,
+            'runs': runs,
+            'hit_rate': sum(1 for r in group if r['hit']) / runs,
+            'avg_exit_price': sum(r['exit_price'] for r in group) / runs,
+            'avg_pnl_percent': sum(r['pnl_percent'] for r in group) / runs,
+            'avg_locked_profit_percent': sum(r['locked_profit_percent'] for r in group) / runs,
+        })
+    summary.sort(key=lambda row: row['avg_pnl_percent'], reverse=True)
+    return summary
+
+def write_csv(path, rows, fields):
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(rows)
+
+def _number_list(text):
+    return [float(value) for value in text.split(',') if value.strip()]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('paths', nargs='+', help='CSV/.npy files or directories of them')
+    parser.add_argument('--percents', type=_number_list, default=[0.5, 1.0, 1.5, 2.0, 3.0],
+                        help='comma-separated stop-loss percents')
+    parser.add_argument('--atr-multipliers', type=_number_list, default=[0.0],
+                        help='comma-separated ATR multipliers (0 is percent only)')
+    parser.add_argument('--references', default=stops.REFERENCE_LTP,
+                        help=f"comma-separated trailing references from {', '.join(stops.REFERENCES)}")
+    parser.add_argument('--sides', default='BUY', help='BUY, SELL or BUY,SELL')
+    parser.add_argument('--product', default='CNC', help='product used to resolve the AUTO reference')
+    parser.add_argument('--interval', help='only use .npy bar segments of this interval, e.g. 1m')
+    parser.add_argument('--workers', type=int, default=None, help='process pool size (default: CPU count)')
+    parser.add_argument('--scalar', action='store_true', help='step every combination through stops.py instead of NumPy')
+    parser.add_argument('--output', help='write one row per symbol and combination to this CSV')
+    parser.add_argument('--summary', help='write the per-combination summary to this CSV')
+    parser.add_argument('--top', type=int, default=20, help='summary rows to print')
+    args = parser.parse_args()
+
+    references = [value.strip().upper() for value in args.references.split(',')]
+    unknown = [value for value in references if value not in stops.REFERENCES]
+    if unknown:
+        parser.error(f"unknown reference(s): {', '.join(unknown)}")
+    sides = [value.strip().upper() for value in args.sides.split(',')]
+    if any(side not in ('BUY', 'SELL') for side in sides):
+        parser.error("sides must be BUY and/or SELL")
+
+    results = run_backtest(args.paths, sides, references, args.percents, args.atr_multipliers,
+                           args.product, args.workers, args.scalar, args.interval)
+    if not results:
+        print("No results; check the input paths.")
+        return 1
+    summary = summarize(results)
+    if args.output:
+        write_csv(args.output, results, RESULT_FIELDS)
+    if args.summary:
+        write_csv(args.summary, summary, list(summary[0].keys()))
+
+    print(f"{len(results)} runs over {len({r['symbol'] for r in results})} symbols and {len(summary)} combinations")
+    print(f"{'side':<5} {'ref':<6} {'sl%':>6} {'atr x':>6} {'runs':>6} {'hit rate':>9} {'avg pnl%':>9} {'avg locked%':>12}")
+    for row in summary[:args.top]:
+        print(f"{row['side']:<5} {row['reference']:<6} {row['stoploss_percent']:>6.2f} {row['atr_multiplier']:>6.2f} "
+              f"{row['runs']:>6} {row['hit_rate']:>9.1%} {row['avg_pnl_percent']:>9.2f} {row['avg_locked_profit_percent']:>12.2f}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,133 @@
+import os
+import re
+import importlib.util
+import threading
+import time
+import logging
+from collections import deque
+from datetime import date
+
+# Bar intervals in seconds, keyed by the name used in the API
+INTERVALS = {'1s': 1, '1m': 60, '5m': 300}
+
+# Column order of a bar, both in memory and in flushed .npy segments
+BAR_FIELDS = ('start', 'open', 'high', 'low', 'close', 'volume')
+
+def numpy_available():
+    """True if NumPy can be imported for flushing, without paying for the import."""
+    return importlib.util.find_spec('numpy') is not None
+
+class _Series:
+    """Closed bars of one instrument and interval in a ring buffer, plus the bar being built."""
+
+    def __init__(self, seconds, capacity):
+        self.seconds = seconds
+        self.closed = deque(maxlen=capacity)
+        self.current = None
+        self.closed_total = 0
+        self.flushed_total = 0
+
+    def update(self, now, price, volume):
+        start = now - now % self.seconds
+        bar = self.current
+        if bar is None or start != bar[0]:
+            if bar is not None:
+                self.closed.append(bar)
+                self.closed_total += 1
+            self.current = [start, price, price, price, price, volume]
+            return
+        if price > bar[2]:
+            bar[2] = price
+        elif price < bar[3]:
+            bar[3] = price
+        bar[4] = price
+        bar[5] += volume
+
+    def unflushed(self):
+        count = min(self.closed_total - self.flushed_total, len(self.closed))
+        return list(self.closed)[len(self.closed) - count:] if count else []
+
+class BarBuilder:
+    """
+    Builds rolling OHLCV bars per instrument from the live tick stream. Each tick
+    updates every interval in O(1); only the last `capacity` closed bars are kept.
+    """
+
+    def __init__(self, capacity=500, intervals=None):
+        self.capacity = capacity
+        self.intervals = intervals or INTERVALS
+        self.series = {}
+        self.last_cumulative_volume = {}
+        self.lock = threading.Lock()
+
+    def update(self, instrument_key, price, cumulative_volume=None, timestamp=None):
+        """
+        Feeds one tick. Volume per bar is derived from the day's cumulative traded
+        volume that both brokers send in full mode, so repeated quotes add nothing.
+        """
+        now = timestamp if timestamp is not None else time.time()
+        key = str(instrument_key)
+        with self.lock:
+            volume = 0
+            if cumulative_volume is not None:
+                previous = self.last_cumulative_volume.get(key)
+                if previous is not None and cumulative_volume > previous:
+                    volume = cumulative_volume - previous
+                self.last_cumulative_volume[key] = cumulative_volume
+
+            instrument_series = self.series.get(key)
+            if instrument_series is None:
+                instrument_series = self.series[key] = {
+                    name: _Series(seconds, self.capacity) for name, seconds in self.intervals.items()
+                }
+            for series in instrument_series.values():
+                series.update(now, price, volume)
+
+    def get_bars(self, instrument_key, interval, limit=None, include_current=True):
+        """Returns the most recent bars, oldest first, as dicts with BAR_FIELDS keys."""
+        if interval not in self.intervals:
+            raise ValueError(f"Unknown bar interval '{interval}'. Use one of: {', '.join(self.intervals)}")
+        with self.lock:
+            series = self.series.get(str(instrument_key), {}).get(interval)
+            if series is None:
+                return []
+            bars = list(series.closed)
+            if include_current and series.current is not None:
+                bars.append(list(series.current))
+        if limit:
+            bars = bars[-limit:]
+        return [dict(zip(BAR_FIELDS, bar)) for bar in bars]
+
+    def instruments(self):
+        with self.lock:
+            return list(self.series)
+
+    def flush_to_disk(self, directory):
+        """
+        Writes closed bars not yet flushed as columnar .npy segments, one per
+        instrument and interval, under directory/YYYY-MM-DD/. Requires NumPy.
+        Returns the number of segments written.
+        """
+        # Imported here rather than at module level so it stays out of app startup
+        try:
+            import numpy as np
+        except ImportError:
+            logging.warning("NumPy is not installed; skipping bar flush.")
+            return 0
+
+        with self.lock:
+            pending = []
+            for key, instrument_series in self.series.items():
+                for name, series in instrument_series.items():
+                    bars = series.unflushed()
+                    if bars:
+                        pending.append((key, name, bars))
+                        series.flushed_total = series.closed_total
+
+        day_directory = os.path.join(directory, date.today().isoformat())
+        os.makedirs(day_directory, exist_ok=True)
+        for key, name, bars in pending:
+            safe_key = re.sub(r'[^A-Za-z0-9]+', '_', key)
+            filename = f"{safe_key}_{name}_{int(bars[0][0])}.npy"
+            np.save(os.path.join(day_directory, filename), np.asarray(bars, dtype=np.float64))
+        return len(pending)
@@ -0,0 +1,345 @@
+import threading
+import time
+import logging
+from db import get_db_connection
+from brokers import get_upstox_product, upstox_sdk
+
+# How far past the trigger the exit's limit price is set, so a gap still fills
+LIMIT_BUFFER_PERCENT = 0.5
+TICK_SIZE = 0.05
+# Kite rejects an order after 25 modifications; stay clear of that
+MAX_MODIFICATIONS = 20
+# How often an entry that has not filled yet is checked before its stop is placed
+ENTRY_RECHECK_SECONDS = 30.0
+
+# Results of BrokerStopManager.cancel()
+STOP_CANCELLED = 'CANCELLED'    # no stop left at the broker; the local exit goes ahead
+STOP_FILLED = 'FILLED'          # the broker-side stop already exited the position
+STOP_UNRESOLVED = 'UNRESOLVED'  # could not tell; retry the exit later
+# GTT statuses that mean it can no longer trigger
+GTT_GONE_STATUSES = ('cancelled', 'deleted', 'disabled', 'expired', 'rejected')
+
+def stop_tag(order_row_id):
+    """Broker tag of the stop order; distinct from the exit tag so the outbox never mistakes one for the other."""
+    return f"slb{order_row_id}"
+
+def round_to_tick(price):
+    return round(round(price / TICK_SIZE) * TICK_SIZE, 2)
+
+class BrokerStopManager(threading.Thread):
+    """
+    Mirrors the local trailing stop as a stop order held by the broker: a GTT on
+    Zerodha (an SL order for MIS, which GTT does not support) and an SL order on
+    Upstox. Stop moves are coalesced per position so only the latest price is
+    sent, at most once every `min_interval` seconds per position and at most
+    `max_requests_per_second` across all positions. A stop is only placed once
+    the entry order has filled.
+
+    With `enabled` off no stop is placed or moved, but cancel() still takes down
+    stops placed while it was on, so they never fire on top of a local exit.
+    """
+
+    def __init__(self, get_broker_api, enabled=True, min_interval=2.0, max_requests_per_second=5):
+        super().__init__(daemon=True)
+        self.get_broker_api = get_broker_api
+        self.enabled = enabled
+        self.min_interval = min_interval
+        self.max_requests_per_second = max_requests_per_second
+        self.condition = threading.Condition()
+        self.pending = {}
+        self.last_sent = {}
+        self.stop_ids = {}
+        self.modifications = {}
+        self.entry_checks = {}
+        self.request_times = []
+        self.closed = set()
+        # Serializes broker calls so a cancel never races an in-flight modify
+        self.sync_lock = threading.Lock()
+        self.running = True
+
+    def request(self, order, stop_price, ltp):
+        """Records the latest desired stop for an order row; replaces any unsent one."""
+        if not self.enabled:
+            return
+        with self.condition:
+            if order['id'] in self.closed:
+                return
+            self.pending[order['id']] = (dict(order), stop_price, ltp)
+            self.condition.notify()
+
+    def has_stop(self, order):
+        """True if the broker holds a live, trailed stop for the order, so the local engine is only a backstop."""
+        return self.enabled and bool(self.stop_ids.get(order['id']) or order['broker_stop_id'])
+
+    def close(self, order_row_id):
+        """Stops placing or moving the stop of an order that is no longer open."""
+        with self.condition:
+            self.closed.add(order_row_id)
+            self.pending.pop(order_row_id, None)
+            self.entry_checks.pop(order_row_id, None)
+
+    def run(self):
+        while self.running:
+            with self.condition:
+                item = self._next_due()
+                while item is None and self.running:
+                    self.condition.wait(timeout=self._seconds_until_due())
+                    item = self._next_due()
+            if item is None:
+                break
+            order, stop_price, ltp = item
+            with self.sync_lock:
+                if order['id'] in self.closed:
+                    continue
+                try:
+                    self._sync(order, stop_price, ltp)
+                except Exception as e:
+                    logging.error(f"Error syncing broker-side stop for {order['symbol']}: {e}")
+
+    def _next_due(self):
+        """Pops the first pending stop whose position and the global rate limit allow a request now."""
+        now = time.time()
+        self.request_times = [t for t in self.request_times if now - t < 1]
+        if len(self.request_times) >= self.max_requests_per_second:
+            return None
+        for order_row_id in list(self.pending):
+            if now < self.entry_checks.get(order_row_id, 0):
+                continue
+            if now - self.last_sent.get(order_row_id, 0) >= self.min_interval:
+                self.last_sent[order_row_id] = now
+                self.request_times.append(now)
+                return self.pending.pop(order_row_id)
+        return None
+
+    def _seconds_until_due(self):
+        if not self.pending:
+            return None
+        now = time.time()
+        earliest = min(max(self.last_sent.get(order_row_id, 0) + self.min_interval, self.entry_checks.get(order_row_id, 0))
+                       for order_row_id in self.pending)
+        if len(self.request_times) >= self.max_requests_per_second:
+            earliest = max(earliest, self.request_times[0] + 1)
+        return max(earliest - now, 0.01)
+
+    def _sync(self, order, stop_price, ltp):
+        order_row_id = order['id']
+        stop_id = self.stop_ids.get(order_row_id) or order['broker_stop_id']
+        exit_transaction_type = 'SELL' if order['transaction_type'] == 'BUY' else 'BUY'
+        trigger_price = round_to_tick(stop_price)
+        if exit_transaction_type == 'SELL':
+            limit_price = round_to_tick(stop_price * (1 - LIMIT_BUFFER_PERCENT / 100))
+        else:
+            limit_price = round_to_tick(stop_price * (1 + LIMIT_BUFFER_PERCENT / 100))
+
+        broker_api = self.get_broker_api(order['broker'])
+        if stop_id:
+            modifications = self.modifications.get(order_row_id, 0)
+            if modifications >= MAX_MODIFICATIONS:
+                if modifications == MAX_MODIFICATIONS:
+                    logging.warning(f"Broker-side stop {stop_id} for {order['symbol']} reached {MAX_MODIFICATIONS} "
+                                    f"modifications and stays at its last price; the local engine keeps trailing.")
+                    self.modifications[order_row_id] = modifications + 1
+                return
+            self.modifications[order_row_id] = modifications + 1
+        elif not self._entry_filled(broker_api, order, stop_price, ltp):
+            return
+
+        if order['broker'] == 'Zerodha':
+            stop_id = self._sync_zerodha(broker_api, order, stop_id, exit_transaction_type, trigger_price, limit_price, ltp)
+        elif order['broker'] == 'Upstox':
+            stop_id = self._sync_upstox(broker_api, order, stop_id, exit_transaction_type, trigger_price, limit_price)
+
+        if stop_id and stop_id != self.stop_ids.get(order_row_id):
+            self.stop_ids[order_row_id] = stop_id
+            conn = get_db_connection()
+            conn.execute('UPDATE orders SET broker_stop_id = ? WHERE id = ?', (str(stop_id), order_row_id))
+            conn.commit()
+            conn.close()
+        logging.info(f"Broker-side stop for {order['symbol']} set to {trigger_price} (id: {stop_id}).")
+
+    def _entry_filled(self, broker_api, order, stop_price, ltp):
+        """
+        A stop placed before the entry fills could open a position of its own (or,
+        for MIS, be rejected), so the first placement waits for the fill. An entry
+        that is still working is checked again every ENTRY_RECHECK_SECONDS.
+        """
+        try:
+            state = self._order_state(broker_api, order['broker'], order['order_id'])
+        except Exception as e:
+            logging.warning(f"Could not fetch the status of entry {order['order_id']}: {e}")
+            state = STOP_UNRESOLVED
+        if state == STOP_FILLED:
+            self.entry_checks.pop(order['id'], None)
+            return True
+        if state == STOP_CANCELLED:
+            logging.info(f"Entry {order['order_id']} for {order['symbol']} did not fill; no broker-side stop placed.")
+            self.close(order['id'])
+            return False
+        with self.condition:
+            self.entry_checks[order['id']] = time.time() + ENTRY_RECHECK_SECONDS
+            if order['id'] not in self.closed:
+                self.pending.setdefault(order['id'], (order, stop_price, ltp))
+        return False
+
+    def _sync_zerodha(self, kite, order, stop_id, exit_transaction_type, trigger_price, limit_price, ltp):
+        if order['product'] == 'MIS':
+            if stop_id:
+                kite.modify_order(variety="regular", order_id=stop_id, order_type='SL',
+                                  trigger_price=trigger_price, price=limit_price)
+                return stop_id
+            return kite.place_order(
+                variety="regular", exchange=order['exchange'], tradingsymbol=order['symbol'],
+                transaction_type=exit_transaction_type, quantity=order['quantity'],
+                product=order['product'], order_type='SL',
+                trigger_price=trigger_price, price=limit_price,
+                tag=stop_tag(order['id'])
+            )
+
+        gtt_orders = [{
+            'exchange': order['exchange'],
+            'tradingsymbol': order['symbol'],
+            'transaction_type': exit_transaction_type,
+            'quantity': order['quantity'],
+            'order_type': 'LIMIT',
+            'product': order['product'],
+            'price': limit_price
+        }]
+        if stop_id:
+            kite.modify_gtt(trigger_id=stop_id, trigger_type=kite.GTT_TYPE_SINGLE,
+                            tradingsymbol=order['symbol'], exchange=order['exchange'],
+                            trigger_values=[trigger_price], last_price=ltp, orders=gtt_orders)
+            return stop_id
+        response = kite.place_gtt(trigger_type=kite.GTT_TYPE_SINGLE,
+                                  tradingsymbol=order['symbol'], exchange=order['exchange'],
+                                  trigger_values=[trigger_price], last_price=ltp, orders=gtt_orders)
+        return response['trigger_id']
+
+    def _sync_upstox(self, order_api, order, stop_id, exit_transaction_type, trigger_price, limit_price):
+        upstox_client = upstox_sdk()
+        if stop_id:
+            order_api.modify_order(
+                body=upstox_client.ModifyOrderRequest(
+                    order_id=stop_id, quantity=order['quantity'], validity="DAY",
+                    order_type='SL', price=limit_price, trigger_price=trigger_price,
+                    disclosed_quantity=0
+                ),
+                api_version="v2"
+            )
+            return stop_id
+        api_response = order_api.place_order(
+            api_version="v3",
+            body=upstox_client.PlaceOrderRequest(
+                quantity=order['quantity'],
+                product=get_upstox_product(order['product']),
+                validity="DAY",
+                instrument_token=order['instrument_key'],
+                order_type='SL',
+                transaction_type='s' if exit_transaction_type == 'SELL' else 'b',
+                price=limit_price,
+                disclosed_quantity=0,
+                trigger_price=trigger_price,
+                is_amo=False,
+                tag=stop_tag(order['id'])
+            )
+        )
+        return api_response.data.order_ids[0] if api_response.data.order_ids else None
+
+    def cancel(self, order_row_id, broker):
+        """
+        Cancels the broker-side stop before the local engine exits the position.
+        Returns STOP_CANCELLED if there is no stop left at the broker (go ahead with
+        the local exit), STOP_FILLED if it already filled there (skip the local
+        exit), or STOP_UNRESOLVED if neither could be established (retry later).
+        """
+        self.close(order_row_id)
+
+        with self.sync_lock:
+            conn = get_db_connection()
+            row = conn.execute('SELECT broker_stop_id, product FROM orders WHERE id = ?', (order_row_id,)).fetchone()
+            conn.close()
+            stop_id = self.stop_ids.pop(order_row_id, None) or (row['broker_stop_id'] if row else None)
+            if not stop_id:
+                return STOP_CANCELLED
+
+            broker_api = self.get_broker_api(broker)
+            try:
+                self._cancel_stop(broker_api, broker, row['product'], stop_id)
+                logging.info(f"Cancelled broker-side stop {stop_id}.")
+                return STOP_CANCELLED
+            except Exception as e:
+                logging.warning(f"Could not cancel broker-side stop {stop_id}: {e}")
+
+            # The cancel may have failed because the stop fired, or only because of a
+            # rate limit or network error; ask the broker which.
+            try:
+                state = self._stop_state(broker_api, broker, row['product'], stop_id)
+            except Exception as e:
+                logging.warning(f"Could not fetch the status of broker-side stop {stop_id}: {e}")
+                return STOP_UNRESOLVED
+            logging.info(f"Broker-side stop {stop_id} is {state} after a failed cancel.")
+            return state
+
+    def _cancel_stop(self, broker_api, broker, product, stop_id):
+        if broker == 'Zerodha':
+            if product == 'MIS':
+                broker_api.cancel_order(variety="regular", order_id=stop_id)
+            else:
+                broker_api.delete_gtt(trigger_id=stop_id)
+        elif broker == 'Upstox':
+            broker_api.cancel_order(order_id=stop_id, api_version="v2")
+
+    def stop_filled(self, order):
+        """
+        True if the order's broker-side stop has already exited the position. Only
+        asks the broker; unlike cancel() it never takes anything down.
+        """
+        stop_id = self.stop_ids.get(order['id']) or order['broker_stop_id']
+        if not stop_id:
+            return False
+        with self.sync_lock:
+            broker_api = self.get_broker_api(order['broker'])
+            state = self._stop_state(broker_api, order['broker'], order['product'], stop_id, cancel_open_limit=False)
+        return state == STOP_FILLED
+
+    def _stop_state(self, broker_api, broker, product, stop_id, cancel_open_limit=True):
+        """Maps the broker's view of a stop that could not be cancelled to a cancel() result."""
+        if broker == 'Zerodha' and product != 'MIS':
+            gtt = broker_api.get_gtt(trigger_id=stop_id)
+            status = (gtt.get('status') or '').lower()
+            if status in GTT_GONE_STATUSES:
+                return STOP_CANCELLED
+            if status != 'triggered':
+                return STOP_UNRESOLVED
+            # A triggered GTT placed a LIMIT order, which may not have filled in a gap
+            result = ((gtt.get('orders') or [{}])[0].get('result') or {}).get('order_result') or {}
+            limit_order_id = result.get('order_id')
+            if not limit_order_id:
+                return STOP_UNRESOLVED
+            state = self._order_state(broker_api, broker, limit_order_id)
+            if state == STOP_UNRESOLVED and cancel_open_limit:
+                # Still open at the broker; take it down so the market exit replaces it
+                try:
+                    broker_api.cancel_order(variety="regular", order_id=limit_order_id)
+                    return STOP_CANCELLED
+                except Exception as e:
+                    logging.warning(f"Could not cancel GTT order {limit_order_id}: {e}")
+            return state
+        return self._order_state(broker_api, broker, stop_id)
+
+    def _order_state(self, broker_api, broker, order_id):
+        if broker == 'Zerodha':
+            history = broker_api.order_history(order_id=order_id)
+            status = history[-1]['status'] if history else ''
+        else:
+            status = broker_api.get_order_details(api_version="v2", order_id=order_id).data.status or ''
+        status = status.upper()
+        if status in ('COMPLETE', 'FILLED'):
+            return STOP_FILLED
+        if status in ('CANCELLED', 'REJECTED'):
+            return STOP_CANCELLED
+        return STOP_UNRESOLVED
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
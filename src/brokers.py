@@ -0,0 +1,59 @@
+# Broker-specific helpers shared by the Flask app and the background workers.
+# The broker SDKs are imported on first use: the app only pays for the SDK of
+# the broker that actually logs in.
+import os
+import threading
+
+# With FAKE_BROKER=1 every broker call goes to the local stand-in in fake_broker.py
+FAKE_BROKER = os.environ.get('FAKE_BROKER') == '1'
+
+_kite = None
+_kite_lock = threading.Lock()
+
+def get_kite():
+    """Returns the shared KiteConnect client. Its API key is set from settings at login."""
+    global _kite
+    if _kite is None:
+        with _kite_lock:
+            if _kite is None:
+                if FAKE_BROKER:
+                    from fake_broker import FakeKiteConnect as KiteConnect
+                else:
+                    from kiteconnect import KiteConnect
+                _kite = KiteConnect(api_key=None)
+    return _kite
+
+def kite_ticker_class():
+    """Returns the KiteTicker class, importing it on first use."""
+    if FAKE_BROKER:
+        from fake_broker import FakeKiteTicker
+        return FakeKiteTicker
+    from kiteconnect import KiteTicker
+    return KiteTicker
+
+def upstox_sdk():
+    """Returns the upstox_client package, importing the (large) generated SDK on first use."""
+    if FAKE_BROKER:
+        import fake_broker
+        return fake_broker
+    import upstox_client
+    return upstox_client
+
+def get_upstox_product(product_str):
+    return {"MIS": "I", "CNC": "D", "NRML": "I"}.get(product_str, "I")
+
+# Kite exceptions that mean the order was refused, as opposed to a network,
+# rate-limit or server error where it may or may not have been placed.
+KITE_REJECTION_EXCEPTIONS = ('InputException', 'OrderException', 'PermissionException')
+
+def is_definite_rejection(error):
+    """
+    True if a broker error means the order was refused outright, so retrying the
+    same request cannot succeed. Matched by name and status so the SDKs need not
+    be imported to check.
+    """
+    if type(error).__name__ in KITE_REJECTION_EXCEPTIONS:
+        return True
+    # upstox_client.rest.ApiException carries the HTTP status
+    status = getattr(error, 'status', None)
+    return isinstance(status, int) and 400 <= status < 500 and status not in (401, 408, 429)
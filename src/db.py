@@ -1,8 +1,8 @@
 import sqlite3
-import requests
 import gzip
 import json
 import logging
+import threading
 
 DATABASE_NAME = 'orders.db'
 
@@ -20,23 +20,71 @@ def init_db():
     cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='orders'")
     orders_table_exists = cursor.fetchone()
     
+    # Construct an absolute path to the schema.sql file
+    script_dir = os.path.dirname(os.path.realpath(__file__))
+    schema_path = os.path.join(script_dir, '..', 'schema.sql')
+    with open(schema_path, 'r') as f:
+        schema = f.read()
+
     if not orders_table_exists:
         print("Initializing database...")
-        # Construct an absolute path to the schema.sql file
-        script_dir = os.path.dirname(os.path.realpath(__file__))
-        schema_path = os.path.join(script_dir, '..', 'schema.sql')
-        with open(schema_path, 'r') as f:
-            conn.executescript(f.read())
+        conn.executescript(schema)
         print("Database initialized.")
     else:
         print("Database already initialized.")
-        
+        apply_additive_schema(conn, schema)
+        add_missing_columns(conn)
+
     conn.close()
 
+_db_initialized = False
+_db_init_lock = threading.Lock()
+
+def ensure_db_initialized():
+    """Runs init_db once per process, on first use rather than at import time."""
+    global _db_initialized
+    if not _db_initialized:
+        with _db_init_lock:
+            if not _db_initialized:
+                init_db()
+                _db_initialized = True
+
+def apply_additive_schema(conn, schema):
+    """
+    Runs only the CREATE ... IF NOT EXISTS statements from the schema, so tables
+    added after a database was first created appear without dropping any data.
+    """
+    for statement in schema.split(';'):
+        lines = [line for line in statement.strip().splitlines() if not line.strip().startswith('--')]
+        statement = '\n'.join(lines).strip()
+        if statement.upper().startswith(('CREATE TABLE IF NOT EXISTS', 'CREATE INDEX IF NOT EXISTS')):
+            conn.execute(statement)
+    conn.commit()
+
+# Columns added to existing tables after their first release, with their
+# definitions as they appear in schema.sql.
+ADDED_COLUMNS = {
+    'orders': [
+        ('trail_reference', "TEXT DEFAULT 'AUTO'"),
+        ('atr_multiplier', 'REAL DEFAULT 0'),
+        ('broker_stop_id', 'TEXT'),
+    ],
+}
+
+def add_missing_columns(conn):
+    """Adds columns from ADDED_COLUMNS that an older database does not have yet."""
+    for table, columns in ADDED_COLUMNS.items():
+        existing = {row['name'] for row in conn.execute(f'PRAGMA table_info({table})').fetchall()}
+        for name, definition in columns:
+            if name not in existing:
+                conn.execute(f'ALTER TABLE {table} ADD COLUMN {name} {definition}')
+    conn.commit()
+
 def update_upstox_instruments():
     logging.info("Starting Upstox instrument list update...")
     url = "https://assets.upstox.com/market-quote/instruments/exchange/complete.json.gz"
     try:
+        import requests
         response = requests.get(url)
         response.raise_for_status()
 
@@ -0,0 +1,171 @@
+import os
+import re
+import mmap
+import queue
+import threading
+import time
+import logging
+from array import array
+from datetime import date, datetime
+
+# Event kinds, stored as one byte
+STOP_MOVED = 1
+TRIGGERED = 2
+ORDER_PLACED = 3
+ORDER_FAILED = 4
+BROKER_STATUS = 5
+KILL_SWITCH_EXIT = 6
+KIND_NAMES = {
+    STOP_MOVED: 'STOP_MOVED',
+    TRIGGERED: 'TRIGGERED',
+    ORDER_PLACED: 'ORDER_PLACED',
+    ORDER_FAILED: 'ORDER_FAILED',
+    BROKER_STATUS: 'BROKER_STATUS',
+    KILL_SWITCH_EXIT: 'KILL_SWITCH_EXIT',
+}
+
+# Broker order statuses, stored in the aux column of BROKER_STATUS events
+STATUS_CODES = {'OPEN': 1, 'COMPLETE': 2, 'FILLED': 2, 'CANCELLED': 3, 'REJECTED': 4, 'TRIGGER PENDING': 5}
+STATUS_NAMES = {1: 'OPEN', 2: 'COMPLETE', 3: 'CANCELLED', 4: 'REJECTED', 5: 'TRIGGER PENDING'}
+
+# One fixed-width file per column: name -> array typecode
+COLUMNS = (
+    ('ts', 'd'),
+    ('kind', 'B'),
+    ('order_row_id', 'q'),
+    ('price', 'd'),
+    ('stop', 'd'),
+    ('aux', 'i'),
+)
+
+NAN = float('nan')
+
+def _safe_name(instrument_key):
+    return re.sub(r'[^A-Za-z0-9]+', '_', str(instrument_key))
+
+class EventStore(threading.Thread):
+    """
+    Append-only, per-trading-day columnar store of stop and order events.
+
+    record() only puts a tuple on a queue; a background thread batches events
+    and appends them to directory/YYYY-MM-DD/<instrument>/<column>.bin, one
+    fixed-width file per column. Reading an instrument's day memory-maps those
+    files and copies each column out in one go, so a full day loads in
+    milliseconds without parsing anything.
+    """
+
+    def __init__(self, directory='events', batch_seconds=0.2):
+        super().__init__(daemon=True)
+        self.directory = directory
+        self.batch_seconds = batch_seconds
+        self.events = queue.Queue()
+        self.repaired = set()
+
+    def record(self, kind, instrument_key, order_row_id=0, price=NAN, stop=NAN, aux=0):
+        """Queues one event. Safe to call from the tick hot path."""
+        self.events.put_nowait((time.time(), kind, str(instrument_key), order_row_id or 0,
+                                NAN if price is None else price, NAN if stop is None else stop, aux))
+
+    def run(self):
+        while True:
+            batch = [self.events.get()]
+            if batch[0] is None:
+                break
+            deadline = time.time() + self.batch_seconds
+            while True:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    event = self.events.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if event is None:
+                    self.events.put(None)
+                    break
+                batch.append(event)
+            try:
+                self._append(batch)
+            except Exception as e:
+                logging.error(f"Error writing {len(batch)} events to the event store: {e}")
+
+    def _append(self, batch):
+        partitions = {}
+        for ts, kind, instrument_key, order_row_id, price, stop, aux in batch:
+            day = datetime.fromtimestamp(ts).date().isoformat()
+            columns = partitions.get((day, instrument_key))
+            if columns is None:
+                columns = partitions[(day, instrument_key)] = [array(typecode) for _, typecode in COLUMNS]
+            for column, value in zip(columns, (ts, kind, order_row_id, price, stop, aux)):
+                column.append(value)
+
+        for (day, instrument_key), columns in partitions.items():
+            partition = os.path.join(self.directory, day, _safe_name(instrument_key))
+            os.makedirs(partition, exist_ok=True)
+            if partition not in self.repaired:
+                self._repair(partition)
+                self.repaired.add(partition)
+            for (name, _), column in zip(COLUMNS, columns):
+                with open(os.path.join(partition, f"{name}.bin"), 'ab') as f:
+                    column.tofile(f)
+
+    def _repair(self, partition):
+        """Cuts every column back to the shortest one, in case a crash interrupted an append."""
+        paths = [(os.path.join(partition, f"{name}.bin"), array(typecode).itemsize) for name, typecode in COLUMNS]
+        rows = min((os.path.getsize(path) // itemsize if os.path.exists(path) else 0) for path, itemsize in paths)
+        for path, itemsize in paths:
+            if os.path.exists(path) and os.path.getsize(path) != rows * itemsize:
+                logging.warning(f"Truncating {path} to {rows} complete events.")
+                os.truncate(path, rows * itemsize)
+            elif not os.path.exists(path):
+                open(path, 'wb').close()
+
+    def stop(self):
+        """Writes out everything queued so far and stops the writer."""
+        self.events.put(None)
+        self.join(timeout=5)
+
+    def query(self, instrument_key, day=None, kinds=None):
+        """
+        Returns one instrument's events for a day (default today) as a dict of
+        column name -> array, oldest first. Optionally keeps only some kinds.
+        Raises ValueError if `day` is not a YYYY-MM-DD date.
+        """
+        # Parsed rather than trusted, since it becomes part of a path
+        day = date.fromisoformat(day).isoformat() if day else date.today().isoformat()
+        partition = os.path.join(self.directory, day, _safe_name(instrument_key))
+        result = {name: array(typecode) for name, typecode in COLUMNS}
+        if not os.path.isdir(partition):
+            return result
+
+        # A batch may be half-written while we read; only take complete rows
+        sizes = {name: os.path.getsize(os.path.join(partition, f"{name}.bin")) // array(typecode).itemsize
+                 for name, typecode in COLUMNS}
+        rows = min(sizes.values())
+        if rows == 0:
+            return result
+        for name, typecode in COLUMNS:
+            itemsize = array(typecode).itemsize
+            with open(os.path.join(partition, f"{name}.bin"), 'rb') as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    result[name].frombytes(mapped[:rows * itemsize])
+
+        if kinds:
+            keep = [i for i, kind in enumerate(result['kind']) if kind in kinds]
+            result = {name: array(typecode, (result[name][i] for i in keep)) for name, typecode in COLUMNS}
+        return result
+
+    def query_rows(self, instrument_key, day=None, kinds=None):
+        """Like query(), but as a list of dicts with readable kind and status names, for audit views."""
+        columns = self.query(instrument_key, day, kinds)
+        rows = []
+        for i in range(len(columns['ts'])):
+            kind = columns['kind'][i]
+            row = {name: columns[name][i] for name, _ in COLUMNS}
+            row['kind'] = KIND_NAMES.get(kind, str(kind))
+            row['price'] = None if row['price'] != row['price'] else row['price']
+            row['stop'] = None if row['stop'] != row['stop'] else row['stop']
+            if kind == BROKER_STATUS:
+                row['status'] = STATUS_NAMES.get(row['aux'], 'UNKNOWN')
+            rows.append(row)
+        return rows
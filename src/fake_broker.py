@@ -0,0 +1,360 @@
+import itertools
+import queue
+import random
+import threading
+import time
+import logging
+from types import SimpleNamespace
+
+# A local stand-in for the parts of kiteconnect and upstox_client this app uses,
+# for load tests and development without broker credentials. Turn it on with
+# FAKE_BROKER=1 (see brokers.py). Every call goes through one FakeExchange that
+# applies the configured latency, rate limit and reject rate.
+
+class FakeBrokerError(Exception):
+    pass
+
+class FakeExchange:
+    """
+    Shared state behind the fake clients: orders, GTTs and the connected tickers.
+    `latency` is seconds added to every REST call, `rate_limit` is requests per
+    second (None for unlimited) and `reject_rate` is the fraction of orders that
+    end up REJECTED.
+    """
+
+    def __init__(self, latency=0.0, rate_limit=None, reject_rate=0.0, seed=None):
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.reject_rate = reject_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.order_ids = itertools.count(1)
+        self.orders = {}
+        self.order_log = []
+        self.gtts = {}
+        self.request_times = []
+        self.tickers = []
+
+    def configure(self, latency=None, rate_limit=None, reject_rate=None):
+        if latency is not None:
+            self.latency = latency
+        if rate_limit is not None:
+            self.rate_limit = rate_limit
+        if reject_rate is not None:
+            self.reject_rate = reject_rate
+
+    def call(self):
+        """Applies latency and the rate limit to one REST call."""
+        if self.latency:
+            time.sleep(self.latency)
+        if self.rate_limit is None:
+            return
+        now = time.time()
+        with self.lock:
+            self.request_times = [t for t in self.request_times if now - t < 1]
+            if len(self.request_times) >= self.rate_limit:
+                raise FakeBrokerError("Too many requests")
+            self.request_times.append(now)
+
+    def submit(self, **order):
+        """Records an order and returns its id. Rejections are reported through the order status, like the real brokers."""
+        self.call()
+        received_at = time.time()
+        with self.lock:
+            order_id = str(next(self.order_ids))
+            if self.random.random() < self.reject_rate:
+                status = 'REJECTED'
+            elif order.get('order_type') in ('SL', 'SL-M'):
+                status = 'TRIGGER PENDING'
+            else:
+                status = 'COMPLETE'
+            order.update(order_id=order_id, status=status, received_at=received_at)
+            self.orders[order_id] = order
+            self.order_log.append(order)
+        return order_id
+
+    def modify(self, order_id, **changes):
+        self.call()
+        with self.lock:
+            order = self.orders.get(str(order_id))
+            if order is None or order['status'] not in ('OPEN', 'TRIGGER PENDING'):
+                raise FakeBrokerError(f"Order {order_id} cannot be modified")
+            order.update({key: value for key, value in changes.items() if value is not None})
+
+    def cancel(self, order_id):
+        self.modify(order_id, status='CANCELLED')
+
+    def publish(self, ticks_by_key):
+        """Sends one round of ticks ({instrument_key: price}) to every connected ticker."""
+        for ticker in list(self.tickers):
+            ticker.deliver(ticks_by_key)
+
+# --- Kite (Zerodha) ---
+
+def _kite_depth(price, spread=0.05, levels=5):
+    return {
+        'buy': [{'price': round(price - spread * (i + 1), 2), 'quantity': 100, 'orders': 1} for i in range(levels)],
+        'sell': [{'price': round(price + spread * (i + 1), 2), 'quantity': 100, 'orders': 1} for i in range(levels)],
+    }
+
+class FakeKiteConnect:
+    GTT_TYPE_SINGLE = 'single'
+
+    def __init__(self, api_key=None, exchange=None):
+        self.api_key = api_key
+        self.exchange = exchange or default_exchange
+        self.access_token = None
+
+    def set_access_token(self, access_token):
+        self.access_token = access_token
+
+    def login_url(self):
+        return "/callback/zerodha?request_token=fake"
+
+    def generate_session(self, request_token, api_secret=None):
+        return {'access_token': 'fake-zerodha-token'}
+
+    def instruments(self):
+        return []
+
+    def place_order(self, variety, exchange, tradingsymbol, transaction_type, quantity, product, order_type,
+                    price=None, trigger_price=None, tag=None, **kwargs):
+        return self.exchange.submit(
+            broker='Zerodha', exchange=exchange, tradingsymbol=tradingsymbol, transaction_type=transaction_type,
+            quantity=quantity, product=product, order_type=order_type, price=price, trigger_price=trigger_price, tag=tag
+        )
+
+    def modify_order(self, variety, order_id, price=None, trigger_price=None, order_type=None, **kwargs):
+        self.exchange.modify(order_id, price=price, trigger_price=trigger_price, order_type=order_type)
+        return order_id
+
+    def cancel_order(self, variety, order_id, **kwargs):
+        self.exchange.cancel(order_id)
+        return order_id
+
+    def orders(self):
+        self.exchange.call()
+        with self.exchange.lock:
+            return [dict(order) for order in self.exchange.orders.values() if order['broker'] == 'Zerodha']
+
+    def order_history(self, order_id):
+        self.exchange.call()
+        order = self.exchange.orders.get(str(order_id))
+        return [dict(order)] if order else []
+
+    def place_gtt(self, trigger_type, tradingsymbol, exchange, trigger_values, last_price, orders):
+        self.exchange.call()
+        with self.exchange.lock:
+            trigger_id = next(self.exchange.order_ids)
+            self.exchange.gtts[trigger_id] = {'id': trigger_id, 'status': 'active', 'tradingsymbol': tradingsymbol,
+                                              'trigger_values': trigger_values, 'orders': orders}
+        return {'trigger_id': trigger_id}
+
+    def modify_gtt(self, trigger_id, trigger_type, tradingsymbol, exchange, trigger_values, last_price, orders):
+        self.exchange.call()
+        with self.exchange.lock:
+            gtt = self.exchange.gtts.get(int(trigger_id))
+            if gtt is None or gtt['status'] != 'active':
+                raise FakeBrokerError(f"GTT {trigger_id} is not active")
+            gtt.update(trigger_values=trigger_values, orders=orders)
+        return {'trigger_id': trigger_id}
+
+    def delete_gtt(self, trigger_id):
+        self.exchange.call()
+        with self.exchange.lock:
+            gtt = self.exchange.gtts.get(int(trigger_id))
+            if gtt is None or gtt['status'] != 'active':
+                raise FakeBrokerError(f"GTT {trigger_id} is not active")
+            gtt['status'] = 'deleted'
+        return {'trigger_id': trigger_id}
+
+    def get_gtt(self, trigger_id):
+        self.exchange.call()
+        with self.exchange.lock:
+            gtt = self.exchange.gtts.get(int(trigger_id))
+            if gtt is None:
+                raise FakeBrokerError(f"GTT {trigger_id} not found")
+            return dict(gtt)
+
+class _FakeTicker:
+    """Delivers published ticks on its own thread, like the real streaming clients."""
+
+    def __init__(self, exchange):
+        self.exchange = exchange
+        self.subscribed = set()
+        self.inbox = queue.Queue()
+        self.connected = False
+        self.thread = None
+
+    def _start(self):
+        self.connected = True
+        self.exchange.tickers.append(self)
+        self.thread = threading.Thread(target=self._deliver_loop, daemon=True)
+        self.thread.start()
+
+    def _stop(self):
+        self.connected = False
+        if self in self.exchange.tickers:
+            self.exchange.tickers.remove(self)
+        self.inbox.put(None)
+
+    def deliver(self, ticks_by_key):
+        wanted = {key: price for key, price in ticks_by_key.items() if str(key) in self.subscribed}
+        if wanted:
+            self.inbox.put(wanted)
+
+    def backlog(self):
+        return self.inbox.qsize()
+
+    def _deliver_loop(self):
+        while True:
+            ticks_by_key = self.inbox.get()
+            if ticks_by_key is None:
+                break
+            try:
+                self._dispatch(ticks_by_key)
+            except Exception as e:
+                logging.error(f"Fake ticker callback failed: {e}")
+
+class FakeKiteTicker(_FakeTicker):
+    MODE_LTP = 'ltp'
+    MODE_QUOTE = 'quote'
+    MODE_FULL = 'full'
+
+    def __init__(self, api_key, access_token, exchange=None):
+        super().__init__(exchange or default_exchange)
+        self.on_ticks = None
+        self.on_connect = None
+        self.on_close = None
+        self.volume = {}
+
+    def connect(self, threaded=False):
+        self._start()
+        if self.on_connect:
+            self.on_connect(self, {})
+
+    def is_connected(self):
+        return self.connected
+
+    def subscribe(self, instrument_tokens):
+        self.subscribed.update(str(token) for token in instrument_tokens)
+
+    def unsubscribe(self, instrument_tokens):
+        self.subscribed.difference_update(str(token) for token in instrument_tokens)
+
+    def set_mode(self, mode, instrument_tokens):
+        pass
+
+    def close(self, code=None, reason=None):
+        self._stop()
+        if self.on_close:
+            self.on_close(self, code, reason)
+
+    def _dispatch(self, ticks_by_key):
+        ticks = []
+        for key, price in ticks_by_key.items():
+            self.volume[key] = self.volume.get(key, 0) + 100
+            ticks.append({
+                'instrument_token': int(key), 'mode': self.MODE_FULL, 'last_price': price,
+                'volume_traded': self.volume[key], 'depth': _kite_depth(price)
+            })
+        if self.on_ticks:
+            self.on_ticks(self, ticks)
+
+# --- Upstox ---
+# Request and configuration classes mirror upstox_client, so brokers.upstox_sdk()
+# can hand this module out in place of the real package.
+
+class Configuration:
+    def __init__(self):
+        self.access_token = None
+
+class ApiClient:
+    def __init__(self, configuration=None):
+        self.configuration = configuration
+
+class PlaceOrderRequest(SimpleNamespace):
+    pass
+
+class ModifyOrderRequest(SimpleNamespace):
+    pass
+
+class LoginApi:
+    def token(self, api_version, code, client_id, client_secret, redirect_uri, grant_type):
+        return SimpleNamespace(access_token='fake-upstox-token')
+
+class OrderApi:
+    def __init__(self, api_client=None, exchange=None):
+        self.api_client = api_client
+        self.exchange = exchange or default_exchange
+
+    def place_order(self, body, api_version):
+        order_id = self.exchange.submit(
+            broker='Upstox', instrument_token=body.instrument_token, transaction_type=body.transaction_type,
+            quantity=body.quantity, product=body.product, order_type=body.order_type, price=body.price,
+            trigger_price=body.trigger_price, tag=getattr(body, 'tag', None)
+        )
+        return SimpleNamespace(data=SimpleNamespace(order_ids=[order_id]))
+
+    def modify_order(self, body, api_version):
+        self.exchange.modify(body.order_id, price=body.price, trigger_price=body.trigger_price, order_type=body.order_type)
+        return SimpleNamespace(data=SimpleNamespace(order_id=body.order_id))
+
+    def cancel_order(self, order_id, api_version):
+        self.exchange.cancel(order_id)
+        return SimpleNamespace(data=SimpleNamespace(order_id=order_id))
+
+    def get_order_details(self, api_version, order_id):
+        self.exchange.call()
+        order = self.exchange.orders.get(str(order_id))
+        if order is None:
+            raise FakeBrokerError(f"Order {order_id} not found")
+        return SimpleNamespace(data=SimpleNamespace(**order))
+
+    def get_order_book(self, api_version):
+        self.exchange.call()
+        with self.exchange.lock:
+            return SimpleNamespace(data=[SimpleNamespace(**order) for order in self.exchange.orders.values()
+                                         if order['broker'] == 'Upstox'])
+
+class MarketDataStreamer(_FakeTicker):
+    def __init__(self, api_client=None, instrument_keys=None, mode='full', exchange=None):
+        super().__init__(exchange or default_exchange)
+        self.subscribed.update(instrument_keys or [])
+        self.handlers = {}
+        self.volume = {}
+        self.closed = threading.Event()
+
+    def on(self, event, handler):
+        self.handlers[event] = handler
+
+    def connect(self):
+        """Blocks until disconnect(), like the SDK's event loop."""
+        self._start()
+        if 'open' in self.handlers:
+            self.handlers['open']()
+        self.closed.wait()
+
+    def subscribe(self, instrument_keys, mode):
+        self.subscribed.update(instrument_keys)
+
+    def unsubscribe(self, instrument_keys):
+        self.subscribed.difference_update(instrument_keys)
+
+    def disconnect(self):
+        self._stop()
+        self.closed.set()
+        if 'close' in self.handlers:
+            self.handlers['close'](1000, 'disconnected')
+
+    def _dispatch(self, ticks_by_key):
+        feeds = {}
+        for key, price in ticks_by_key.items():
+            self.volume[key] = self.volume.get(key, 0) + 100
+            depth = _kite_depth(price)
+            feeds[key] = {'ff': {'ltpc': {'ltp': price}, 'market_depth': depth, 'vtt': self.volume[key]}}
+        if 'message' in self.handlers:
+            self.handlers['message']({'feeds': feeds})
+
+# The exchange the fake clients use unless one is passed explicitly
+default_exchange = FakeExchange()
@@ -0,0 +1,195 @@
+import json
+import logging
+import time
+from db import get_db_connection
+
+# Outbox entry states. An entry is PENDING until the order worker claims it,
+# CLAIMED while the exit is in flight, DONE once placed, and FAILED only when the
+# broker refused the order outright. Any other error returns it to PENDING.
+PENDING = 'PENDING'
+CLAIMED = 'CLAIMED'
+DONE = 'DONE'
+FAILED = 'FAILED'
+
+# Order status of a position whose exit the broker refused; it is neither
+# trailed nor retried until re-armed from the orders table.
+EXIT_FAILED = 'EXIT_FAILED'
+
+# Retries after an error that may be transient (timeout, rate limit, network).
+# After MAX_ATTEMPTS the entry stays PENDING until the next login or restart.
+MAX_ATTEMPTS = 8
+RETRY_BASE_SECONDS = 1.0
+RETRY_MAX_SECONDS = 60.0
+
+def exit_tag(order_row_id):
+    """
+    Returns the deterministic broker order tag for the exit of a local order.
+    Kite limits tags to 20 alphanumeric characters, so keep it short.
+    """
+    return f"slx{order_row_id}"
+
+def build_exit_details(order):
+    """Builds the exit order payload for an open (or triggered) order row."""
+    exit_transaction_type = 'SELL' if order['transaction_type'] == 'BUY' else 'BUY'
+    return {
+        'order_id': order['id'],
+        'broker': order['broker'],
+        'exchange': order['exchange'],
+        'symbol': order['symbol'],
+        'transaction_type': exit_transaction_type,
+        'quantity': order['quantity'],
+        'product': order['product'],
+        'instrument_key': order['instrument_key'],
+        'tag': exit_tag(order['id'])
+    }
+
+def _log_event(conn, outbox_id, event, detail=None):
+    conn.execute(
+        'INSERT INTO order_outbox_log (outbox_id, event, detail, created_at) VALUES (?, ?, ?, ?)',
+        (outbox_id, event, detail, time.time())
+    )
+
+def enqueue_exit(conn, order_details):
+    """
+    Writes an exit order to the outbox using the caller's connection, so the
+    entry commits atomically with the TRIGGERED status update.
+    Returns the outbox id, or None if an exit was already recorded for the order.
+    """
+    now = time.time()
+    cursor = conn.execute(
+        'INSERT OR IGNORE INTO order_outbox (order_row_id, broker, tag, payload, status, attempts, created_at, updated_at) '
+        'VALUES (?, ?, ?, ?, ?, 0, ?, ?)',
+        (order_details['order_id'], order_details['broker'], order_details['tag'],
+         json.dumps(order_details), PENDING, now, now)
+    )
+    if cursor.rowcount == 0:
+        return None
+    outbox_id = cursor.lastrowid
+    _log_event(conn, outbox_id, 'ENQUEUED')
+    return outbox_id
+
+def claim(outbox_id):
+    """
+    Claims a PENDING entry for placement. Returns (order_details, attempts) for
+    the claimed entry, or None if it is not pending (already claimed or finished).
+    """
+    conn = get_db_connection()
+    try:
+        cursor = conn.execute(
+            'UPDATE order_outbox SET status = ?, attempts = attempts + 1, updated_at = ? WHERE id = ? AND status = ?',
+            (CLAIMED, time.time(), outbox_id, PENDING)
+        )
+        if cursor.rowcount == 0:
+            conn.commit()
+            return None
+        _log_event(conn, outbox_id, 'CLAIMED')
+        conn.commit()
+        entry = conn.execute('SELECT payload, attempts FROM order_outbox WHERE id = ?', (outbox_id,)).fetchone()
+        return json.loads(entry['payload']), entry['attempts']
+    finally:
+        conn.close()
+
+def release(outbox_id, reason):
+    """Returns a claimed entry to PENDING so it is dispatched again later."""
+    conn = get_db_connection()
+    conn.execute(
+        'UPDATE order_outbox SET status = ?, updated_at = ? WHERE id = ? AND status = ?',
+        (PENDING, time.time(), outbox_id, CLAIMED)
+    )
+    _log_event(conn, outbox_id, 'RELEASED', reason)
+    conn.commit()
+    conn.close()
+
+def retry_delay(attempts):
+    """Seconds to wait before retrying after `attempts` failed tries, or None once MAX_ATTEMPTS is reached."""
+    if attempts >= MAX_ATTEMPTS:
+        return None
+    return min(RETRY_BASE_SECONDS * 2 ** (attempts - 1), RETRY_MAX_SECONDS)
+
+def mark_done(outbox_id, order_row_id, broker_order_id=None):
+    """Marks the entry DONE and closes the local order in one transaction."""
+    conn = get_db_connection()
+    conn.execute(
+        'UPDATE order_outbox SET status = ?, broker_order_id = ?, updated_at = ? WHERE id = ?',
+        (DONE, broker_order_id, time.time(), outbox_id)
+    )
+    conn.execute('UPDATE orders SET status = ? WHERE id = ?', ('CLOSED', order_row_id))
+    _log_event(conn, outbox_id, 'DONE', broker_order_id)
+    conn.commit()
+    conn.close()
+
+def mark_failed(outbox_id, order_row_id, error):
+    """
+    Marks the entry FAILED and the order EXIT_FAILED in one transaction. Only for
+    a definite broker rejection; rearm() puts the position back under the stop.
+    """
+    conn = get_db_connection()
+    conn.execute(
+        'UPDATE order_outbox SET status = ?, updated_at = ? WHERE id = ?',
+        (FAILED, time.time(), outbox_id)
+    )
+    conn.execute('UPDATE orders SET status = ? WHERE id = ?', (EXIT_FAILED, order_row_id))
+    _log_event(conn, outbox_id, 'FAILED', str(error))
+    conn.commit()
+    conn.close()
+
+def rearm(order_row_id):
+    """
+    Returns an EXIT_FAILED order to OPEN so the stop trails and triggers it again.
+    Its FAILED outbox entry is removed (the log keeps its history) so the next
+    trigger can enqueue a fresh exit. Returns False if the order was not EXIT_FAILED.
+    """
+    conn = get_db_connection()
+    try:
+        cursor = conn.execute('UPDATE orders SET status = ? WHERE id = ? AND status = ?',
+                              ('OPEN', order_row_id, EXIT_FAILED))
+        if cursor.rowcount == 0:
+            conn.rollback()
+            return False
+        entry = conn.execute('SELECT id FROM order_outbox WHERE order_row_id = ? AND status = ?',
+                             (order_row_id, FAILED)).fetchone()
+        if entry is not None:
+            _log_event(conn, entry['id'], 'REARMED')
+            conn.execute('DELETE FROM order_outbox WHERE id = ?', (entry['id'],))
+        conn.commit()
+        return True
+    finally:
+        conn.close()
+
+def recover_pending_exits():
+    """
+    Startup recovery. Entries left CLAIMED by a crashed process are returned to
+    PENDING (the worker checks the broker for their tag before re-placing), and
+    TRIGGERED orders that never made it into the outbox get an entry.
+    Must only run before the order worker starts claiming entries.
+    """
+    conn = get_db_connection()
+    try:
+        stale = conn.execute('SELECT id FROM order_outbox WHERE status = ?', (CLAIMED,)).fetchall()
+        for entry in stale:
+            conn.execute('UPDATE order_outbox SET status = ?, updated_at = ? WHERE id = ?',
+                         (PENDING, time.time(), entry['id']))
+            _log_event(conn, entry['id'], 'RECOVERED')
+
+        orphaned = conn.execute(
+            'SELECT * FROM orders WHERE status = "TRIGGERED" AND id NOT IN (SELECT order_row_id FROM order_outbox)'
+        ).fetchall()
+        for order in orphaned:
+            enqueue_exit(conn, build_exit_details(order))
+        conn.commit()
+
+        if stale or orphaned:
+            logging.info(f"Outbox recovery: {len(stale)} in-flight and {len(orphaned)} orphaned exit(s) re-queued.")
+    finally:
+        conn.close()
+
+def pending_exit_ids(broker=None):
+    """Returns the ids of all PENDING outbox entries, optionally filtered by broker."""
+    conn = get_db_connection()
+    if broker:
+        rows = conn.execute('SELECT id FROM order_outbox WHERE status = ? AND broker = ? ORDER BY id',
+                            (PENDING, broker)).fetchall()
+    else:
+        rows = conn.execute('SELECT id FROM order_outbox WHERE status = ? ORDER BY id', (PENDING,)).fetchall()
+    conn.close()
+    return [row['id'] for row in rows]
@@ -0,0 +1,53 @@
+import stops
+
+class NormalizedTick:
+    """
+    The only fields of a broker tick the stop engine looks at. Depth levels are
+    references to the broker's own lists, not copies.
+    """
+    __slots__ = ('instrument_key', 'ltp', 'best_bid', 'best_ask', 'cumulative_volume', 'bid_levels', 'ask_levels')
+
+    def __init__(self, instrument_key, ltp, best_bid=None, best_ask=None, cumulative_volume=None,
+                 bid_levels=None, ask_levels=None):
+        self.instrument_key = instrument_key
+        self.ltp = ltp
+        self.best_bid = best_bid
+        self.best_ask = best_ask
+        self.cumulative_volume = cumulative_volume
+        self.bid_levels = bid_levels
+        self.ask_levels = ask_levels
+
+class Position:
+    """
+    An OPEN order held in memory by the tick handler, with numeric columns
+    converted once when loaded. Slots are named after the orders table columns
+    and support order['column'] access, so a Position can be used anywhere an
+    orders row is expected.
+    """
+    __slots__ = ('id', 'order_id', 'symbol', 'quantity', 'price', 'initial_stoploss', 'current_stoploss_price',
+                 'transaction_type', 'exchange', 'product', 'broker', 'instrument_key', 'trail_reference',
+                 'atr_multiplier', 'broker_stop_id', 'is_long')
+
+    def __init__(self, row):
+        self.id = row['id']
+        self.order_id = row['order_id']
+        self.symbol = row['symbol']
+        self.quantity = int(row['quantity'])
+        self.price = float(row['price'])
+        self.initial_stoploss = float(row['initial_stoploss'])
+        self.current_stoploss_price = float(row['current_stoploss_price'])
+        self.transaction_type = row['transaction_type']
+        self.exchange = row['exchange']
+        self.product = row['product']
+        self.broker = row['broker']
+        self.instrument_key = row['instrument_key']
+        self.trail_reference = row['trail_reference'] or stops.REFERENCE_AUTO
+        self.atr_multiplier = float(row['atr_multiplier'] or 0)
+        self.broker_stop_id = row['broker_stop_id']
+        self.is_long = stops.is_long(self.transaction_type)
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def keys(self):
+        return self.__slots__
@@ -0,0 +1,147 @@
+import threading
+import logging
+
+class PortfolioRisk:
+    """
+    Portfolio-wide exposure kept up to date from the tick stream. Each position
+    remembers the MTM and capital at risk it last contributed, so a tick only
+    applies the difference to the per-broker and total figures: O(1) per tick
+    regardless of how many positions are open.
+
+    Capital at risk is what the position would lose from here if its stop were
+    hit: qty * (ltp - stop) for longs and qty * (stop - ltp) for shorts.
+    MARKET orders are stored without a price, so their MTM is measured from the
+    first LTP seen for them.
+    Drawdown is measured on total P&L (realized + unrealized) from its peak.
+
+    A removed position stays removed: a tick already in flight on another
+    thread cannot add it back. Only restore() (a re-armed position) lifts that.
+
+    When a threshold is crossed, `on_breach(reason)` is called once, outside the
+    lock, until `reset()` re-arms the kill switch. A threshold of None is off.
+    """
+
+    def __init__(self, max_loss=None, max_drawdown=None, max_capital_at_risk=None, on_breach=None):
+        self.max_loss = max_loss
+        self.max_drawdown = max_drawdown
+        self.max_capital_at_risk = max_capital_at_risk
+        self.on_breach = on_breach
+        self.lock = threading.Lock()
+        self.contributions = {}
+        self.entry_prices = {}
+        self.removed = set()
+        self.broker_mtm = {}
+        self.broker_capital_at_risk = {}
+        self.unrealized = 0.0
+        self.realized = 0.0
+        self.capital_at_risk = 0.0
+        self.peak_pnl = 0.0
+        self.drawdown = 0.0
+        self.tripped = None
+
+    def update(self, position, ltp):
+        """Applies one tick of one position to the aggregates. Ignored for removed positions."""
+        quantity = position.quantity
+        broker = position.broker
+        with self.lock:
+            if position.id in self.removed:
+                return
+            entry_price = position.price
+            if entry_price <= 0:
+                entry_price = self.entry_prices.setdefault(position.id, ltp)
+            if position.is_long:
+                mtm = quantity * (ltp - entry_price)
+                at_risk = quantity * (ltp - position.current_stoploss_price)
+            else:
+                mtm = quantity * (entry_price - ltp)
+                at_risk = quantity * (position.current_stoploss_price - ltp)
+
+            previous_mtm, previous_at_risk = self.contributions.get(position.id, (0.0, 0.0))
+            self.contributions[position.id] = (mtm, at_risk)
+            delta_mtm = mtm - previous_mtm
+            delta_at_risk = at_risk - previous_at_risk
+            self.unrealized += delta_mtm
+            self.capital_at_risk += delta_at_risk
+            self.broker_mtm[broker] = self.broker_mtm.get(broker, 0.0) + delta_mtm
+            self.broker_capital_at_risk[broker] = self.broker_capital_at_risk.get(broker, 0.0) + delta_at_risk
+            reason = self._check_thresholds()
+        if reason:
+            self._breach(reason)
+
+    def remove(self, position_id, broker, realize=True):
+        """
+        Drops a position that was exited; its last MTM becomes realized P&L. With
+        realize=False (an entry that never filled) the MTM is simply discarded.
+        """
+        with self.lock:
+            self.removed.add(position_id)
+            self.entry_prices.pop(position_id, None)
+            contribution = self.contributions.pop(position_id, None)
+            if contribution is None:
+                return
+            mtm, at_risk = contribution
+            self.unrealized -= mtm
+            if realize:
+                self.realized += mtm
+            self.capital_at_risk -= at_risk
+            self.broker_mtm[broker] = self.broker_mtm.get(broker, 0.0) - mtm
+            self.broker_capital_at_risk[broker] = self.broker_capital_at_risk.get(broker, 0.0) - at_risk
+
+    def restore(self, position_id):
+        """Lets a removed position contribute again, for one that was re-armed after a failed exit."""
+        with self.lock:
+            self.removed.discard(position_id)
+
+    def _check_thresholds(self):
+        """Updates the drawdown and returns a breach reason, if any. Caller holds the lock."""
+        pnl = self.realized + self.unrealized
+        if pnl > self.peak_pnl:
+            self.peak_pnl = pnl
+        self.drawdown = self.peak_pnl - pnl
+
+        if self.tripped:
+            return None
+        if self.max_loss is not None and pnl <= -self.max_loss:
+            self.tripped = f"portfolio loss {pnl:.2f} reached the limit of -{self.max_loss:.2f}"
+        elif self.max_drawdown is not None and self.drawdown >= self.max_drawdown:
+            self.tripped = f"drawdown {self.drawdown:.2f} reached the limit of {self.max_drawdown:.2f}"
+        elif self.max_capital_at_risk is not None and self.capital_at_risk >= self.max_capital_at_risk:
+            self.tripped = f"capital at risk {self.capital_at_risk:.2f} reached the limit of {self.max_capital_at_risk:.2f}"
+        return self.tripped
+
+    def _breach(self, reason):
+        logging.warning(f"--- PORTFOLIO KILL SWITCH: {reason} ---")
+        if self.on_breach is not None:
+            try:
+                self.on_breach(reason)
+            except Exception as e:
+                logging.error(f"Error running the portfolio kill switch: {e}")
+
+    def reset(self):
+        """Re-arms the kill switch and restarts drawdown tracking from the current P&L."""
+        with self.lock:
+            self.tripped = None
+            self.peak_pnl = self.realized + self.unrealized
+            self.drawdown = 0.0
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'unrealized_pnl': self.unrealized,
+                'realized_pnl': self.realized,
+                'total_pnl': self.realized + self.unrealized,
+                'capital_at_risk': self.capital_at_risk,
+                'peak_pnl': self.peak_pnl,
+                'drawdown': self.drawdown,
+                'open_positions': len(self.contributions),
+                'by_broker': {
+                    broker: {'mtm': self.broker_mtm[broker], 'capital_at_risk': self.broker_capital_at_risk.get(broker, 0.0)}
+                    for broker in self.broker_mtm
+                },
+                'kill_switch': {
+                    'max_loss': self.max_loss,
+                    'max_drawdown': self.max_drawdown,
+                    'max_capital_at_risk': self.max_capital_at_risk,
+                    'tripped': self.tripped,
+                },
+            }
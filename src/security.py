@@ -1,9 +1,14 @@
-from cryptography.fernet import Fernet
 import logging
+import threading
 from db import get_db_connection
 
+# One Fernet per process; the key never changes once it has been generated
+_fernet = None
+_fernet_lock = threading.Lock()
+
 def generate_key():
     """Generates a new Fernet encryption key."""
+    from cryptography.fernet import Fernet
     return Fernet.generate_key()
 
 def get_or_generate_encryption_key():
@@ -32,9 +37,14 @@ def get_or_generate_encryption_key():
         return new_key
 
 def get_fernet_instance():
-    """Creates a Fernet instance with the application's encryption key."""
-    key = get_or_generate_encryption_key()
-    return Fernet(key)
+    """Returns the Fernet instance for the application's encryption key, created on first use."""
+    global _fernet
+    if _fernet is None:
+        with _fernet_lock:
+            if _fernet is None:
+                from cryptography.fernet import Fernet
+                _fernet = Fernet(get_or_generate_encryption_key())
+    return _fernet
 
 def encrypt_value(value: str) -> bytes:
     """Encrypts a string value."""
@@ -0,0 +1,173 @@
+# Pure trailing stop-loss rules shared by the live tick handler and offline tools.
+# Nothing in here touches the database or a broker, and every function is O(1).
+import time
+
+# Price references a position can trail on.
+REFERENCE_AUTO = 'AUTO'      # LTP for CNC, best bid/ask for MIS and NRML
+REFERENCE_LTP = 'LTP'
+REFERENCE_TOUCH = 'TOUCH'    # best bid for longs, best ask for shorts
+REFERENCE_MID = 'MID'
+REFERENCE_DEPTH = 'DEPTH'    # quantity-weighted price of the visible book side we would exit into
+REFERENCES = (REFERENCE_AUTO, REFERENCE_LTP, REFERENCE_TOUCH, REFERENCE_MID, REFERENCE_DEPTH)
+
+INTRADAY_PRODUCTS = ('MIS', 'NRML')
+
+def is_long(transaction_type):
+    """Positions opened with a SELL are shorts; everything else is long."""
+    return transaction_type != 'SELL'
+
+def depth_weighted_price(levels):
+    """Returns the quantity-weighted price of a list of depth levels, or None if the book side is empty."""
+    total_quantity = 0
+    notional = 0.0
+    for level in levels:
+        quantity = level.get('quantity') or 0
+        total_quantity += quantity
+        notional += level['price'] * quantity
+    if total_quantity <= 0:
+        return None
+    return notional / total_quantity
+
+def select_reference_price(reference, product, long_position, ltp, best_bid=None, best_ask=None, exit_levels=None):
+    """
+    Picks the price the stop trails on. Longs exit into the bid side of the book
+    and shorts into the ask side, so TOUCH and DEPTH use that side. Falls back to
+    LTP whenever the book side needed is missing.
+    """
+    touch = best_bid if long_position else best_ask
+
+    if reference == REFERENCE_AUTO:
+        reference = REFERENCE_TOUCH if product in INTRADAY_PRODUCTS else REFERENCE_LTP
+
+    if reference == REFERENCE_TOUCH and touch is not None:
+        return touch
+    if reference == REFERENCE_MID and best_bid is not None and best_ask is not None:
+        return (best_bid + best_ask) / 2
+    if reference == REFERENCE_DEPTH and exit_levels:
+        weighted = depth_weighted_price(exit_levels)
+        if weighted is not None:
+            return weighted
+    return ltp
+
+def stop_distance(reference_price, stoploss_percent, atr=0.0, atr_multiplier=0.0):
+    """
+    Distance between the reference price and the stop. The percentage acts as a
+    floor; a volatility-scaled distance widens it when the market is noisier.
+    """
+    distance = reference_price * stoploss_percent / 100
+    volatility_distance = atr * atr_multiplier
+    return volatility_distance if volatility_distance > distance else distance
+
+def initial_stop(long_position, price, stoploss_percent):
+    """Stop price set when the order is placed (0 when the entry price is unknown)."""
+    if price <= 0:
+        return 0
+    if long_position:
+        return price * (1 - stoploss_percent / 100)
+    return price * (1 + stoploss_percent / 100)
+
+def is_triggered(long_position, ltp, current_stop):
+    """A stop of 0 means it has not been set yet and never triggers."""
+    if current_stop <= 0:
+        return False
+    if long_position:
+        return ltp <= current_stop
+    return ltp >= current_stop
+
+def backstop_price(long_position, stop, buffer_percent):
+    """
+    Trigger price for the local engine when the broker holds the real stop: a
+    little past it, so the broker-side order gets the first chance to fill.
+    """
+    if long_position:
+        return stop * (1 - buffer_percent / 100)
+    return stop * (1 + buffer_percent / 100)
+
+def trail(long_position, reference_price, current_stop, distance):
+    """
+    Returns the new stop if the reference moved far enough to tighten it, else None.
+    Longs only ever move the stop up and shorts only ever move it down.
+    """
+    if long_position:
+        candidate = reference_price - distance
+        if candidate > current_stop:
+            return candidate
+    else:
+        candidate = reference_price + distance
+        if current_stop <= 0 or candidate < current_stop:
+            return candidate
+    return None
+
+def tighter_stop(long_position, stop, other_stop):
+    """The tighter of two stops for the same position: the higher for longs, the lower set one for shorts."""
+    if long_position:
+        return max(stop, other_stop)
+    if stop <= 0:
+        return other_stop
+    if other_stop <= 0:
+        return stop
+    return min(stop, other_stop)
+
+def locked_profit_percent(long_position, entry_price, price):
+    """Profit of the position at the given price, in percent of the entry price."""
+    if entry_price <= 0:
+        return 0
+    if long_position:
+        return (price - entry_price) / entry_price * 100
+    return (entry_price - price) / entry_price * 100
+
+class VolatilityTracker:
+    """
+    Incremental average true range over time-based bars, using Wilder's smoothing.
+    Ticks are folded into bars of `bar_seconds` (one minute by default) and each
+    closed bar contributes its true range, max(high - low, |high - previous
+    close|, |low - previous close|). That is the usual candle ATR, so a
+    multiplier of 1-3 means one to three typical 1-minute ranges. The value is in
+    price units and is only used once `period` bars have closed.
+    """
+
+    def __init__(self, period=14, bar_seconds=60):
+        self.period = period
+        self.bar_seconds = bar_seconds
+        self.atr = 0.0
+        self.count = 0
+        self.previous_close = None
+        self.bar_start = None
+        self.high = None
+        self.low = None
+        self.close = None
+
+    def update(self, price, timestamp=None):
+        """Adds one tick and returns the ATR as of the last closed bar."""
+        if timestamp is None:
+            timestamp = time.time()
+        start = timestamp - timestamp % self.bar_seconds
+        if start != self.bar_start:
+            if self.bar_start is not None:
+                self.update_bar(self.high, self.low, self.close)
+            self.bar_start = start
+            self.high = self.low = price
+        elif price > self.high:
+            self.high = price
+        elif price < self.low:
+            self.low = price
+        self.close = price
+        return self.atr
+
+    def update_bar(self, high, low, close):
+        """Adds one closed bar. The backtester feeds candles in through here."""
+        if self.previous_close is None:
+            true_range = high - low
+        else:
+            true_range = max(high - low, abs(high - self.previous_close), abs(low - self.previous_close))
+        self.previous_close = close
+        self.count += 1
+        if self.count <= self.period:
+            self.atr += (true_range - self.atr) / self.count
+        else:
+            self.atr += (true_range - self.atr) / self.period
+        return self.atr
+
+    @property
+    def is_warm(self):
+        return self.count >= self.period
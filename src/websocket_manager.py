@@ -1,28 +1,40 @@
 import threading
 import time
 import logging
-import json
-from kiteconnect import KiteTicker
-import upstox_client
-from upstox_client.rest import ApiException
-import websocket
 from db import get_db_connection
+import outbox
+import stops
+import event_store
+from records import NormalizedTick, Position
+from brokers import kite_ticker_class, upstox_sdk
+from broker_stops import STOP_UNRESOLVED
+
+# How far past the stop the local engine waits before exiting when a broker-side stop exists
+BACKSTOP_BUFFER_PERCENT = 0.25
 
 class WebSocketManager(threading.Thread):
     """Base class for WebSocket managers for different brokers."""
-    def __init__(self, broker, access_token, order_queue, api_key=None, broker_api=None):
+    def __init__(self, broker, access_token, order_queue, api_key=None, broker_api=None, bar_builder=None, broker_stops=None, risk=None, events=None):
         super().__init__()
         self.broker = broker
         self.access_token = access_token
         self.api_key = api_key
         self.broker_api = broker_api
         self.order_queue = order_queue
+        self.bar_builder = bar_builder
+        self.broker_stops = broker_stops
+        self.risk = risk
+        self.events = events
         self.ws = None
         self.running = False
         self.subscribed_instruments = set()
+        self.volatility = {}
+        # OPEN positions of this broker by instrument key, so ticks never hit the database for a lookup
+        self.positions = {}
 
     def run(self):
         self.running = True
+        self.load_positions()
         while self.running:
             self.connect()
             # Keep the thread alive while connected, or until stop is called
@@ -35,7 +47,47 @@ class WebSocketManager(threading.Thread):
     def connect(self):
         raise NotImplementedError("Subclasses must implement the connect method.")
 
+    def load_positions(self):
+        """
+        Reloads the OPEN positions of this broker from the database and makes sure
+        their instruments are subscribed. The dict is swapped in whole, so the tick
+        thread never sees a half-built book.
+
+        This runs on the caller's thread while ticks keep trailing the current book,
+        so a position already in it keeps the tighter of its in-memory and stored stop.
+        """
+        conn = get_db_connection()
+        rows = conn.execute('SELECT * FROM orders WHERE status = "OPEN" AND broker = ?', (self.broker,)).fetchall()
+        positions = {}
+        for row in rows:
+            positions.setdefault(str(row['instrument_key']), []).append(Position(row))
+        if self.risk is not None:
+            # Positions closed behind our back (e.g. by the order sync) leave the aggregates.
+            # Entries that were cancelled or rejected never filled, so they realize nothing.
+            open_ids = {row['id'] for row in rows}
+            for instrument_positions in self.positions.values():
+                for position in instrument_positions:
+                    if position.id not in open_ids:
+                        row = conn.execute('SELECT status FROM orders WHERE id = ?', (position.id,)).fetchone()
+                        filled = row is None or row['status'] not in ('CANCELLED', 'REJECTED')
+                        self.risk.remove(position.id, self.broker, realize=filled)
+        conn.close()
+
+        # Done last, right before the swap, to leave the tick thread the least time
+        # to move a stop we have already looked at.
+        current = {position.id: position for instrument_positions in self.positions.values()
+                   for position in instrument_positions}
+        for instrument_positions in positions.values():
+            for position in instrument_positions:
+                previous = current.get(position.id)
+                if previous is not None:
+                    position.current_stoploss_price = stops.tighter_stop(
+                        position.is_long, position.current_stoploss_price, previous.current_stoploss_price)
+        self.positions = positions
+        self.subscribed_instruments.update(positions)
+
     def subscribe(self, instrument_keys):
+        self.load_positions()
         self.subscribed_instruments.update(instrument_keys)
         self._resubscribe()
 
@@ -51,13 +103,21 @@ class WebSocketManager(threading.Thread):
         # This logic is now broker-specific
         raise NotImplementedError("Subclasses must implement the on_tick method.")
 
+    def normalize_tick(self, instrument_token, tick_data):
+        """Extracts a NormalizedTick from a raw broker tick, or returns None if it has no LTP."""
+        raise NotImplementedError("Subclasses must implement the normalize_tick method.")
+
     def sync_order_status(self):
         """
         Queries the broker for the status of all open orders and updates the local database.
+        An order whose broker-side stop already filled is closed, and the broker-side
+        stop of an order that is closed, cancelled or rejected here is cancelled.
         """
         logging.info(f"[{self.broker}] Syncing order status for open orders...")
         conn = get_db_connection()
-        open_orders = conn.execute('SELECT id, order_id FROM orders WHERE status = "OPEN"').fetchall()
+        open_orders = conn.execute(
+            'SELECT id, order_id, symbol, instrument_key, product, broker, broker_stop_id FROM orders WHERE status = "OPEN"'
+        ).fetchall()
 
         if not open_orders:
             logging.info(f"[{self.broker}] No open orders to sync.")
@@ -66,6 +126,13 @@ class WebSocketManager(threading.Thread):
 
         for order in open_orders:
             try:
+                if self.broker_stops is not None and self.broker_stops.stop_filled(order):
+                    self.broker_stops.close(order['id'])
+                    conn.execute('UPDATE orders SET status = ? WHERE id = ?', ('CLOSED', order['id']))
+                    conn.commit()
+                    logging.info(f"  - Order {order['order_id']}: broker-side stop {order['broker_stop_id']} filled; updated to CLOSED.")
+                    continue
+
                 broker_status = None
                 if self.broker == 'Zerodha':
                     order_history = self.broker_api.order_history(order_id=order['order_id'])
@@ -77,6 +144,9 @@ class WebSocketManager(threading.Thread):
                     broker_status = api_response.data.status
 
                 if broker_status:
+                    if self.events is not None:
+                        self.events.record(event_store.BROKER_STATUS, order['instrument_key'], order['id'],
+                                           aux=event_store.STATUS_CODES.get(broker_status.upper(), 0))
                     logging.info(f"  - Order {order['order_id']}: Local Status=OPEN, Broker Status={broker_status}")
                     # If the order is filled on the broker side, close it locally
                     if broker_status.upper() in ['COMPLETE', 'FILLED']:
@@ -88,6 +158,13 @@ class WebSocketManager(threading.Thread):
                         conn.execute('UPDATE orders SET status = ? WHERE id = ?', (broker_status.upper(), order['id']))
                         conn.commit()
                         logging.info(f"    - Updated order {order['order_id']} to {broker_status.upper()}.")
+                    else:
+                        continue
+                    # The order is no longer open here; leave no stop behind at the broker
+                    if self.broker_stops is not None:
+                        if self.broker_stops.cancel(order['id'], self.broker) == STOP_UNRESOLVED:
+                            logging.warning(f"    - Broker-side stop {order['broker_stop_id']} of order {order['order_id']} "
+                                            f"could not be cancelled; check it at the broker.")
 
             except Exception as e:
                 logging.error(f"Error syncing status for order {order['order_id']}: {e}")
@@ -97,92 +174,127 @@ class WebSocketManager(threading.Thread):
 
     def process_tick(self, instrument_token, tick_data):
         """Shared logic to process a tick for any broker."""
-        # --- Broker-specific data extraction ---
-        ltp = None
-        best_bid = None
-        if self.broker == 'Zerodha':
-            ltp = tick_data.get('last_price')
-            if 'depth' in tick_data:
-                try:
-                    best_bid = tick_data['depth']['buy'][0]['price']
-                except (IndexError, KeyError):
-                    best_bid = None # No buy orders in depth
-        elif self.broker == 'Upstox':
-            # Upstox sends either ltpc or ff (full feed)
-            if 'ff' in tick_data:
-                # When in full feed, ltp is inside the ltpc object within ff
-                ltp = tick_data.get('ff', {}).get('ltpc', {}).get('ltp')
-                try:
-                    best_bid = tick_data['ff']['market_depth']['buy'][0]['price']
-                except (IndexError, KeyError):
-                    best_bid = None
-            else:
-                # Fallback to just ltpc if that's all we get
-                ltp = tick_data.get('ltpc', {}).get('ltp')
-
-        if not instrument_token or ltp is None:
+        if not instrument_token:
             return
+        tick = self.normalize_tick(instrument_token, tick_data)
+        if tick is None:
+            return
+        ltp = tick.ltp
+        now = time.time()
 
-        conn = get_db_connection()
-        order = conn.execute(
-            'SELECT * FROM orders WHERE status = "OPEN" AND instrument_key = ?',
-            (str(instrument_token),)
-        ).fetchone()
+        if self.bar_builder is not None:
+            self.bar_builder.update(instrument_token, ltp, tick.cumulative_volume, now)
 
-        if not order:
-            conn.close()
+        # Keep the 1-minute ATR warm for every subscribed instrument, not just
+        # the ones with an open order right now.
+        tracker = self.volatility.get(instrument_token)
+        if tracker is None:
+            tracker = self.volatility[instrument_token] = stops.VolatilityTracker()
+        atr = tracker.update(ltp, now)
+
+        positions = self.positions.get(tick.instrument_key)
+        if not positions:
             return
 
+        for order in list(positions):
+            # A kill switch tripped earlier in this loop may have exited it already
+            if order not in positions:
+                continue
+            try:
+                triggered = self._apply_stop(order, positions, tick, atr if tracker.is_warm else 0.0)
+                if self.risk is not None and not triggered:
+                    self.risk.update(order, ltp)
+            except Exception as e:
+                logging.error(f"Error processing tick for order {order.order_id}: {e}")
+
+    def _trigger_exit(self, order, positions):
+        """Queues the exit of one position and takes it out of the book."""
+        # The outbox entry and the TRIGGERED status commit together, so a crash
+        # before the exit is placed is picked up by startup recovery.
+        # A stale book may still hold a row that was closed or cancelled meanwhile;
+        # only a row that is still OPEN gets an exit.
+        conn = get_db_connection()
         try:
-            initial_price = float(order['price'])
-            stoploss_percent = float(order['initial_stoploss'])
-            current_stoploss_price = float(order['current_stoploss_price'])
-
-            # --- Stop-Loss Trigger Logic (using LTP) ---
-            if ltp <= current_stoploss_price:
-                logging.info(f"--- STOP-LOSS TRIGGERED for order {order['order_id']} at price {ltp} (SL: {current_stoploss_price}) ---")
-                exit_transaction_type = 'SELL' if order['transaction_type'] == 'BUY' else 'BUY'
-                order_details = {
-                    'order_id': order['id'],
-                    'broker': order['broker'],
-                    'exchange': order['exchange'],
-                    'symbol': order['symbol'],
-                    'transaction_type': exit_transaction_type,
-                    'quantity': order['quantity'],
-                    'product': order['product'],
-                    'instrument_key': order['instrument_key']
-                }
-                self.order_queue.put(order_details)
-                conn.execute('UPDATE orders SET status = ? WHERE id = ?', ('TRIGGERED', order['id']))
-                conn.commit()
-
-            # --- Trailing Stop-Loss Logic ---
+            cursor = conn.execute('UPDATE orders SET status = ? WHERE id = ? AND status = ?', ('TRIGGERED', order.id, 'OPEN'))
+            if cursor.rowcount == 0:
+                outbox_id = None
+                conn.rollback()
+                logging.info(f"Order {order.order_id} is no longer OPEN; not queueing an exit.")
             else:
-                # Auto-select the price to use for trailing based on product type
-                product_type = order['product']
-                price_for_trailing = ltp  # Default to LTP for CNC and as a fallback
-
-                if product_type in ['MIS', 'NRML']:
-                    # For intraday/volatile products, use the more conservative best bid price for BUY orders
-                    if order['transaction_type'] == 'BUY' and best_bid is not None:
-                        price_for_trailing = best_bid
-                    # For SELL orders (short-selling), one might use the best ask price.
-                    # This is not implemented as the UI doesn't explicitly support shorting.
-
-                new_stoploss_price = price_for_trailing * (1 - stoploss_percent / 100)
-                if new_stoploss_price > current_stoploss_price:
-                    profit = ((ltp - initial_price) / initial_price) * 100 if initial_price > 0 else 0
-                    conn.execute(
-                        'UPDATE orders SET current_stoploss_price = ?, potential_profit = ? WHERE id = ?',
-                        (new_stoploss_price, profit, order['id'])
-                    )
-                    conn.commit()
-                    logging.info(f"Trailing stop-loss for {order['symbol']} updated to {new_stoploss_price:.2f} (using price: {price_for_trailing}, product: {product_type})")
+                outbox_id = outbox.enqueue_exit(conn, outbox.build_exit_details(order))
+                conn.commit()
+        finally:
+            conn.close()
+        if order in positions:
+            positions.remove(order)
+        if self.risk is not None:
+            self.risk.remove(order.id, self.broker)
+        if outbox_id is not None:
+            self.order_queue.put(outbox_id)
+
+    def exit_all(self, reason):
+        """Queues exits for every open position of this broker at once (the portfolio kill switch)."""
+        for positions in list(self.positions.values()):
+            for order in list(positions):
+                logging.info(f"--- EXITING order {order.order_id} ({order.symbol}): {reason} ---")
+                if self.events is not None:
+                    self.events.record(event_store.KILL_SWITCH_EXIT, order.instrument_key, order.id,
+                                       stop=order.current_stoploss_price)
+                try:
+                    self._trigger_exit(order, positions)
+                except Exception as e:
+                    logging.error(f"Error queueing kill-switch exit for order {order.order_id}: {e}")
 
-        except Exception as e:
-            logging.error(f"Error processing tick for order {order['order_id']}: {e}")
+    def _apply_stop(self, order, positions, tick, atr):
+        """
+        Runs the trigger and trailing rules for one position; touches the database
+        only on a change. Returns True if the position was triggered.
+        """
+        ltp = tick.ltp
+        long_position = order.is_long
+        current_stoploss_price = order.current_stoploss_price
+
+        # When the broker holds the stop, only act as a backstop a little past it
+        trigger_price = current_stoploss_price
+        if self.broker_stops is not None and self.broker_stops.has_stop(order):
+            trigger_price = stops.backstop_price(long_position, current_stoploss_price, BACKSTOP_BUFFER_PERCENT)
+
+        # --- Stop-Loss Trigger Logic (using LTP) ---
+        if stops.is_triggered(long_position, ltp, trigger_price):
+            logging.info(f"--- STOP-LOSS TRIGGERED for order {order.order_id} at price {ltp} (SL: {current_stoploss_price}) ---")
+            if self.events is not None:
+                self.events.record(event_store.TRIGGERED, order.instrument_key, order.id, ltp, current_stoploss_price)
+            self._trigger_exit(order, positions)
+            return True
+
+        # --- Trailing Stop-Loss Logic ---
+        # Longs trail on the bid side and shorts on the ask side of the book
+        price_for_trailing = stops.select_reference_price(
+            order.trail_reference, order.product, long_position, ltp, tick.best_bid, tick.best_ask,
+            tick.bid_levels if long_position else tick.ask_levels
+        )
+        distance = stops.stop_distance(price_for_trailing, order.initial_stoploss, atr, order.atr_multiplier)
+        new_stoploss_price = stops.trail(long_position, price_for_trailing, current_stoploss_price, distance)
+        if new_stoploss_price is None:
+            return False
+
+        profit = stops.locked_profit_percent(long_position, order.price, ltp)
+        conn = get_db_connection()
+        try:
+            conn.execute(
+                'UPDATE orders SET current_stoploss_price = ?, potential_profit = ? WHERE id = ?',
+                (new_stoploss_price, profit, order.id)
+            )
+            conn.commit()
         finally:
             conn.close()
+        order.current_stoploss_price = new_stoploss_price
+        if self.events is not None:
+            self.events.record(event_store.STOP_MOVED, order.instrument_key, order.id, ltp, new_stoploss_price)
+        if self.broker_stops is not None:
+            self.broker_stops.request(order, new_stoploss_price, ltp)
+        logging.info(f"Trailing stop-loss for {order.symbol} updated to {new_stoploss_price:.2f} (using price: {price_for_trailing}, reference: {order.trail_reference}, product: {order.product})")
+        return False
 
     def stop(self):
         self.running = False
@@ -192,8 +304,9 @@ class WebSocketManager(threading.Thread):
 class ZerodhaWebSocketManager(WebSocketManager):
     def connect(self):
         logging.info("Connecting to Zerodha WebSocket...")
-        self.ws = KiteTicker(self.api_key, self.access_token)
-        self.ws.on_ticks = self.on_tick
+        self.ws = kite_ticker_class()(self.api_key, self.access_token)
+        # KiteTicker calls on_ticks(ws, ticks)
+        self.ws.on_ticks = lambda ws, ticks: self.on_tick(ticks)
         self.ws.on_connect = self._on_connect
         self.ws.on_close = lambda ws, code, reason: logging.info(f"Zerodha WebSocket closed: {code} - {reason}")
         self.ws.connect(threaded=True)
@@ -201,12 +314,30 @@ class ZerodhaWebSocketManager(WebSocketManager):
     def _on_connect(self, ws, response):
         logging.info("Zerodha WebSocket connected.")
         self.sync_order_status()
+        self.load_positions()
         self._resubscribe()
 
     def on_tick(self, ticks):
         for tick in ticks:
             self.process_tick(tick.get('instrument_token'), tick)
 
+    def normalize_tick(self, instrument_token, tick_data):
+        ltp = tick_data.get('last_price')
+        if ltp is None:
+            return None
+        best_bid = best_ask = bid_levels = ask_levels = None
+        depth = tick_data.get('depth')
+        if depth:
+            bid_levels = depth.get('buy')
+            ask_levels = depth.get('sell')
+            # Empty depth slots are reported with a price of 0
+            if bid_levels:
+                best_bid = bid_levels[0]['price'] or None
+            if ask_levels:
+                best_ask = ask_levels[0]['price'] or None
+        return NormalizedTick(str(instrument_token), ltp, best_bid, best_ask,
+                              tick_data.get('volume_traded'), bid_levels, ask_levels)
+
     def _resubscribe(self):
         if self.subscribed_instruments and self.ws and self.ws.is_connected():
             int_tokens = [int(t) for t in self.subscribed_instruments]
@@ -218,6 +349,7 @@ class UpstoxWebSocketManager(WebSocketManager):
     def connect(self):
         logging.info("Connecting to Upstox WebSocket using MarketDataStreamer...")
         try:
+            upstox_client = upstox_sdk()
             # The MarketDataStreamer handles the authorization and connection internally.
             # It uses the api_client from the broker_api object, which is already
             # configured with the access token.
@@ -242,6 +374,7 @@ class UpstoxWebSocketManager(WebSocketManager):
     def _on_open(self, *args):
         logging.info("Upstox WebSocket connected.")
         self.sync_order_status()
+        self.load_positions()
         self._resubscribe()
 
     def on_message(self, message):
@@ -254,6 +387,32 @@ class UpstoxWebSocketManager(WebSocketManager):
         except Exception as e:
             logging.error(f"Error processing Upstox message: {e}")
 
+    def normalize_tick(self, instrument_token, tick_data):
+        # Upstox sends either ltpc or ff (full feed)
+        full_feed = tick_data.get('ff')
+        if full_feed is None:
+            # Fallback to just ltpc if that's all we get
+            ltpc = tick_data.get('ltpc')
+            ltp = ltpc.get('ltp') if ltpc else None
+            return NormalizedTick(instrument_token, ltp) if ltp is not None else None
+
+        # When in full feed, ltp is inside the ltpc object within ff
+        ltpc = full_feed.get('ltpc')
+        ltp = ltpc.get('ltp') if ltpc else None
+        if ltp is None:
+            return None
+        best_bid = best_ask = bid_levels = ask_levels = None
+        depth = full_feed.get('market_depth')
+        if depth:
+            bid_levels = depth.get('buy')
+            ask_levels = depth.get('sell')
+            if bid_levels:
+                best_bid = bid_levels[0]['price'] or None
+            if ask_levels:
+                best_ask = ask_levels[0]['price'] or None
+        return NormalizedTick(instrument_token, ltp, best_bid, best_ask,
+                              full_feed.get('vtt'), bid_levels, ask_levels)
+
     def _resubscribe(self):
         if not self.subscribed_instruments:
             return
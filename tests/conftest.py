@@ -0,0 +1,34 @@
+import os
+import sys
+
+import pytest
+
+# The app modules import each other as top-level modules (`from db import ...`)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """A fresh orders.db in a temporary working directory."""
+    import db as db_module
+    monkeypatch.chdir(tmp_path)
+    db_module.init_db()
+    return db_module
+
+@pytest.fixture
+def insert_order(db):
+    """Inserts an order row and returns it. Keyword arguments override the defaults."""
+    def insert(**fields):
+        values = dict(order_id='B1', symbol='INFY', quantity=10, price=100.0, initial_stoploss=1.0,
+                      current_stoploss_price=99.0, status='OPEN', transaction_type='BUY', exchange='NSE',
+                      product='MIS', broker='Zerodha', instrument_key='408065')
+        values.update(fields)
+        conn = db.get_db_connection()
+        cursor = conn.execute(
+            f"INSERT INTO orders ({', '.join(values)}) VALUES ({', '.join('?' * len(values))})",
+            tuple(values.values())
+        )
+        conn.commit()
+        order = conn.execute('SELECT * FROM orders WHERE id = ?', (cursor.lastrowid,)).fetchone()
+        conn.close()
+        return order
+    return insert
@@ -0,0 +1,82 @@
+import random
+
+import pytest
+
+import backtest
+
+SIDES = ['BUY', 'SELL']
+REFERENCES = ['LTP', 'TOUCH', 'MID', 'AUTO']
+PERCENTS = [0.2, 0.5, 1.0, 2.0]
+MULTIPLIERS = [0.0, 1.5, 3.0]
+
+def write_candles(path, rows=150, seed=1):
+    rng = random.Random(seed)
+    price = 100.0
+    lines = ['timestamp,open,high,low,close']
+    for i in range(rows):
+        close = price * (1 + rng.gauss(0.002, 0.002))
+        high = max(price, close) * (1 + abs(rng.gauss(0, 0.002)))
+        low = min(price, close) * (1 - abs(rng.gauss(0, 0.002)))
+        lines.append(f"{1700000000 + 60 * i},{price},{high},{low},{close}")
+        price = close
+    path.write_text('\n'.join(lines) + '\n')
+    return str(path)
+
+def write_ticks(path, rows=2000, seed=2):
+    rng = random.Random(seed)
+    price = 100.0
+    lines = ['timestamp,ltp,bid,ask']
+    for i in range(rows):
+        price *= 1 + rng.gauss(0.0002, 0.0008)
+        # Some ticks carry no book
+        bid, ask = ('', '') if i % 7 == 0 else (f"{price - 0.05}", f"{price + 0.05}")
+        lines.append(f"{1700000000 + 3 * i},{price},{bid},{ask}")
+    path.write_text('\n'.join(lines) + '\n')
+    return str(path)
+
+def run(source, scalar):
+    return backtest.backtest_file(source, SIDES, REFERENCES, PERCENTS, MULTIPLIERS, product='MIS', scalar=scalar)
+
+@pytest.mark.parametrize('write', [write_candles, write_ticks])
+def test_the_numpy_path_matches_the_scalar_path(tmp_path, write):
+    pytest.importorskip('numpy')
+    source = write(tmp_path / 'INFY.csv')
+    scalar = run(source, scalar=True)
+    vectorized = run(source, scalar=False)
+    assert len(vectorized) == len(scalar) == len(SIDES) * len(REFERENCES) * len(PERCENTS) * len(MULTIPLIERS)
+    assert any(result['hit'] for result in scalar)
+    assert any(not result['hit'] for result in scalar)
+    for expected, actual in zip(scalar, vectorized):
+        for field in ('exit_time', 'rows_held', 'hit'):
+            assert actual[field] == expected[field]
+        for field in ('exit_price', 'pnl_percent', 'locked_profit_percent'):
+            assert actual[field] == pytest.approx(expected[field])
+
+def test_find_files_groups_segments_by_instrument_and_interval(tmp_path):
+    names = ['NSE_EQ_1_1m_1700000060.npy', 'NSE_EQ_1_1m_1700000000.npy', 'NSE_EQ_1_5m_1700000000.npy',
+             'NSE_EQ_2_1m_1700000000.npy', 'INFY.csv']
+    for name in names:
+        (tmp_path / name).write_bytes(b'')
+    sources = backtest.find_files([str(tmp_path)])
+    assert sorted(backtest.source_name(source) for source in sources) == [
+        'INFY', 'NSE_EQ_1_1m', 'NSE_EQ_1_5m', 'NSE_EQ_2_1m']
+    [segments] = [source for source in sources if backtest.source_name(source) == 'NSE_EQ_1_1m']
+    assert len(segments) == 2
+
+    only_1m = backtest.find_files([str(tmp_path)], interval='1m')
+    assert sorted(backtest.source_name(source) for source in only_1m) == ['INFY', 'NSE_EQ_1_1m', 'NSE_EQ_2_1m']
+
+def test_segments_are_joined_in_start_order(tmp_path):
+    np = pytest.importorskip('numpy')
+    first = np.array([[1700000000 + 60 * i, 100, 101, 99, 100.5, 10] for i in range(3)], dtype=np.float64)
+    second = np.array([[1700000180 + 60 * i, 100.5, 102, 100, 101.5, 10] for i in range(2)], dtype=np.float64)
+    later = tmp_path / 'NSE_EQ_1_1m_1700000180.npy'
+    earlier = tmp_path / 'NSE_EQ_1_1m_1700000000.npy'
+    np.save(later, second)
+    np.save(earlier, first)
+
+    symbol, kind, columns = backtest.load_series((str(later), str(earlier)))
+    assert symbol == 'NSE_EQ_1_1m'
+    assert kind == backtest.KIND_OHLC
+    assert columns['time'] == [1700000000 + 60 * i for i in range(5)]
+    assert columns['close'] == [100.5] * 3 + [101.5] * 2
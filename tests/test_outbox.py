@@ -0,0 +1,85 @@
+import outbox
+
+def enqueue(db, order):
+    conn = db.get_db_connection()
+    outbox_id = outbox.enqueue_exit(conn, outbox.build_exit_details(order))
+    conn.commit()
+    conn.close()
+    return outbox_id
+
+def outbox_status(db, outbox_id):
+    conn = db.get_db_connection()
+    row = conn.execute('SELECT status FROM order_outbox WHERE id = ?', (outbox_id,)).fetchone()
+    conn.close()
+    return row['status'] if row else None
+
+def order_status(db, order_row_id):
+    conn = db.get_db_connection()
+    row = conn.execute('SELECT status FROM orders WHERE id = ?', (order_row_id,)).fetchone()
+    conn.close()
+    return row['status']
+
+def test_exit_details_reverse_the_side_and_carry_the_tag(db, insert_order):
+    details = outbox.build_exit_details(insert_order(transaction_type='SELL'))
+    assert details['transaction_type'] == 'BUY'
+    assert details['tag'] == outbox.exit_tag(details['order_id'])
+
+def test_an_order_is_enqueued_only_once(db, insert_order):
+    order = insert_order(status='TRIGGERED')
+    assert enqueue(db, order) is not None
+    assert enqueue(db, order) is None
+
+def test_recovery_returns_claimed_entries_to_pending(db, insert_order):
+    outbox_id = enqueue(db, insert_order(status='TRIGGERED'))
+    assert outbox.claim(outbox_id) is not None
+    assert outbox.claim(outbox_id) is None
+    assert outbox_status(db, outbox_id) == outbox.CLAIMED
+
+    outbox.recover_pending_exits()
+
+    assert outbox_status(db, outbox_id) == outbox.PENDING
+    assert outbox.pending_exit_ids() == [outbox_id]
+    details, attempts = outbox.claim(outbox_id)
+    assert attempts == 2
+
+def test_recovery_enqueues_orphaned_triggered_orders(db, insert_order):
+    orphan = insert_order(status='TRIGGERED')
+    insert_order(status='OPEN')
+
+    outbox.recover_pending_exits()
+
+    [outbox_id] = outbox.pending_exit_ids('Zerodha')
+    details, _ = outbox.claim(outbox_id)
+    assert details['order_id'] == orphan['id']
+    assert details['tag'] == outbox.exit_tag(orphan['id'])
+
+def test_recovery_leaves_finished_entries_alone(db, insert_order):
+    order = insert_order(status='TRIGGERED')
+    outbox_id = enqueue(db, order)
+    outbox.claim(outbox_id)
+    outbox.mark_done(outbox_id, order['id'], 'X1')
+
+    outbox.recover_pending_exits()
+
+    assert outbox_status(db, outbox_id) == outbox.DONE
+    assert order_status(db, order['id']) == 'CLOSED'
+    assert outbox.pending_exit_ids() == []
+
+def test_a_rejected_exit_can_be_rearmed(db, insert_order):
+    order = insert_order(status='TRIGGERED')
+    outbox_id = enqueue(db, order)
+    outbox.claim(outbox_id)
+    outbox.mark_failed(outbox_id, order['id'], 'InputException')
+    assert order_status(db, order['id']) == outbox.EXIT_FAILED
+
+    assert outbox.rearm(order['id'])
+    assert not outbox.rearm(order['id'])
+    assert order_status(db, order['id']) == 'OPEN'
+    assert outbox_status(db, outbox_id) is None
+    assert enqueue(db, order) is not None
+
+def test_retry_delay_backs_off_and_gives_up():
+    assert outbox.retry_delay(1) == outbox.RETRY_BASE_SECONDS
+    assert outbox.retry_delay(2) == 2 * outbox.RETRY_BASE_SECONDS
+    assert outbox.retry_delay(outbox.MAX_ATTEMPTS - 1) <= outbox.RETRY_MAX_SECONDS
+    assert outbox.retry_delay(outbox.MAX_ATTEMPTS) is None
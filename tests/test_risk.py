@@ -0,0 +1,73 @@
+from types import SimpleNamespace
+
+import pytest
+
+from risk import PortfolioRisk
+
+def position(id=1, quantity=10, price=100.0, stop=99.0, is_long=True, broker='Zerodha'):
+    return SimpleNamespace(id=id, quantity=quantity, price=price, current_stoploss_price=stop,
+                           is_long=is_long, broker=broker)
+
+def test_update_applies_only_the_change():
+    risk = PortfolioRisk()
+    long_position = position()
+    risk.update(long_position, 101.0)
+    risk.update(long_position, 102.0)
+    risk.update(position(id=2, is_long=False, stop=104.0), 103.0)
+    snapshot = risk.snapshot()
+    assert snapshot['unrealized_pnl'] == pytest.approx(20.0 - 30.0)
+    assert snapshot['capital_at_risk'] == pytest.approx(30.0 + 10.0)
+    assert snapshot['open_positions'] == 2
+
+def test_a_market_order_is_measured_from_its_first_ltp():
+    risk = PortfolioRisk()
+    market_order = position(price=0, is_long=False, stop=0)
+    risk.update(market_order, 250.0)
+    assert risk.snapshot()['unrealized_pnl'] == 0
+    risk.update(market_order, 249.0)
+    assert risk.snapshot()['unrealized_pnl'] == pytest.approx(10.0)
+
+def test_remove_realizes_the_last_mtm():
+    risk = PortfolioRisk()
+    risk.update(position(), 103.0)
+    risk.remove(1, 'Zerodha')
+    snapshot = risk.snapshot()
+    assert snapshot['realized_pnl'] == pytest.approx(30.0)
+    assert snapshot['unrealized_pnl'] == 0
+    assert snapshot['capital_at_risk'] == 0
+
+def test_an_unfilled_entry_realizes_nothing():
+    risk = PortfolioRisk()
+    risk.update(position(), 103.0)
+    risk.remove(1, 'Zerodha', realize=False)
+    assert risk.snapshot()['realized_pnl'] == 0
+
+def test_a_late_tick_does_not_bring_a_removed_position_back():
+    risk = PortfolioRisk()
+    exited = position()
+    risk.update(exited, 101.0)
+    risk.remove(1, 'Zerodha')
+    risk.update(exited, 90.0)
+    snapshot = risk.snapshot()
+    assert snapshot['open_positions'] == 0
+    assert snapshot['unrealized_pnl'] == 0
+    assert snapshot['realized_pnl'] == pytest.approx(10.0)
+
+def test_a_restored_position_contributes_again():
+    risk = PortfolioRisk()
+    risk.remove(1, 'Zerodha')
+    risk.restore(1)
+    risk.update(position(), 101.0)
+    assert risk.snapshot()['unrealized_pnl'] == pytest.approx(10.0)
+
+def test_the_kill_switch_trips_once_until_reset():
+    breaches = []
+    risk = PortfolioRisk(max_loss=50.0, on_breach=breaches.append)
+    losing = position()
+    risk.update(losing, 94.0)
+    risk.update(losing, 93.0)
+    assert len(breaches) == 1
+    risk.reset()
+    assert risk.snapshot()['kill_switch']['tripped'] is None
+    risk.update(losing, 92.0)
+    assert len(breaches) == 2
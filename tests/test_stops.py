@@ -0,0 +1,104 @@
+import pytest
+
+import stops
+
+LONG = True
+SHORT = False
+
+def test_is_long():
+    assert stops.is_long('BUY')
+    assert not stops.is_long('SELL')
+
+def test_trail_moves_a_long_stop_only_up():
+    assert stops.trail(LONG, 110.0, 99.0, 1.0) == 109.0
+    assert stops.trail(LONG, 99.5, 99.0, 1.0) is None
+    assert stops.trail(LONG, 100.0, 99.0, 1.0) is None
+
+def test_trail_moves_a_short_stop_only_down():
+    assert stops.trail(SHORT, 90.0, 101.0, 1.0) == 91.0
+    assert stops.trail(SHORT, 100.5, 101.0, 1.0) is None
+    assert stops.trail(SHORT, 100.0, 101.0, 1.0) is None
+
+def test_trail_sets_an_unset_stop():
+    assert stops.trail(LONG, 100.0, 0, 1.0) == 99.0
+    assert stops.trail(SHORT, 100.0, 0, 1.0) == 101.0
+
+def test_is_triggered():
+    assert stops.is_triggered(LONG, 99.0, 99.0)
+    assert not stops.is_triggered(LONG, 99.5, 99.0)
+    assert stops.is_triggered(SHORT, 101.0, 101.0)
+    assert not stops.is_triggered(SHORT, 100.5, 101.0)
+
+def test_an_unset_stop_never_triggers():
+    assert not stops.is_triggered(LONG, 0.5, 0)
+    assert not stops.is_triggered(SHORT, 1000.0, 0)
+
+def test_auto_reference_depends_on_the_product():
+    assert stops.select_reference_price('AUTO', 'CNC', LONG, 100.0, 99.9, 100.1) == 100.0
+    assert stops.select_reference_price('AUTO', 'MIS', LONG, 100.0, 99.9, 100.1) == 99.9
+    assert stops.select_reference_price('AUTO', 'NRML', SHORT, 100.0, 99.9, 100.1) == 100.1
+
+def test_touch_and_mid_references():
+    assert stops.select_reference_price('TOUCH', 'CNC', LONG, 100.0, 99.9, 100.1) == 99.9
+    assert stops.select_reference_price('TOUCH', 'CNC', SHORT, 100.0, 99.9, 100.1) == 100.1
+    assert stops.select_reference_price('MID', 'MIS', LONG, 100.0, 99.0, 101.0) == 100.0
+
+def test_depth_reference_weights_the_exit_side():
+    bids = [{'price': 100.0, 'quantity': 1}, {'price': 97.0, 'quantity': 2}]
+    assert stops.select_reference_price('DEPTH', 'MIS', LONG, 101.0, 100.0, 101.5, bids) == 98.0
+
+def test_an_empty_book_side_falls_back_to_ltp():
+    assert stops.select_reference_price('TOUCH', 'MIS', LONG, 100.0, None, 100.1) == 100.0
+    assert stops.select_reference_price('TOUCH', 'MIS', SHORT, 100.0, 99.9, None) == 100.0
+    assert stops.select_reference_price('MID', 'MIS', LONG, 100.0, 99.9, None) == 100.0
+    assert stops.select_reference_price('DEPTH', 'MIS', LONG, 100.0, 99.9, 100.1, []) == 100.0
+    empty_levels = [{'price': 99.0, 'quantity': 0}]
+    assert stops.depth_weighted_price(empty_levels) is None
+    assert stops.select_reference_price('DEPTH', 'MIS', LONG, 100.0, 99.9, 100.1, empty_levels) == 100.0
+
+def test_stop_distance_uses_the_wider_of_percent_and_volatility():
+    assert stops.stop_distance(200.0, 1.0) == 2.0
+    assert stops.stop_distance(200.0, 1.0, atr=0.5, atr_multiplier=2) == 2.0
+    assert stops.stop_distance(200.0, 1.0, atr=1.5, atr_multiplier=2) == 3.0
+
+def test_initial_stop():
+    assert stops.initial_stop(LONG, 100.0, 2.0) == pytest.approx(98.0)
+    assert stops.initial_stop(SHORT, 100.0, 2.0) == pytest.approx(102.0)
+    assert stops.initial_stop(LONG, 0, 2.0) == 0
+
+def test_update_bar_uses_the_range_of_the_first_bar():
+    tracker = stops.VolatilityTracker(period=3)
+    assert tracker.update_bar(102.0, 100.0, 101.0) == 2.0
+    assert not tracker.is_warm
+
+def test_update_bar_uses_the_true_range_across_a_gap():
+    tracker = stops.VolatilityTracker(period=3)
+    tracker.update_bar(102.0, 100.0, 101.0)
+    # Gapped up: the range from the previous close (106 - 101) beats high - low (1)
+    assert tracker.update_bar(106.0, 105.0, 105.5) == pytest.approx((2.0 + 5.0) / 2)
+    tracker.update_bar(106.0, 104.0, 105.0)
+    assert tracker.is_warm
+    assert tracker.atr == pytest.approx(3.0)
+
+def test_update_bar_smooths_after_the_period():
+    tracker = stops.VolatilityTracker(period=2)
+    tracker.update_bar(101.0, 99.0, 100.0)
+    tracker.update_bar(101.0, 99.0, 100.0)
+    assert tracker.atr == pytest.approx(2.0)
+    # Wilder: atr += (true_range - atr) / period
+    assert tracker.update_bar(104.0, 100.0, 102.0) == pytest.approx(3.0)
+
+def test_update_folds_ticks_into_bars():
+    tracker = stops.VolatilityTracker(period=2, bar_seconds=60)
+    for price, ts in ((100.0, 0), (103.0, 10), (99.0, 59)):
+        assert tracker.update(price, ts) == 0.0
+    # The first tick of the next minute closes the 99-103 bar
+    assert tracker.update(100.0, 60) == pytest.approx(4.0)
+    assert tracker.count == 1
+
+def test_tighter_stop():
+    assert stops.tighter_stop(LONG, 99.0, 99.5) == 99.5
+    assert stops.tighter_stop(LONG, 0, 99.0) == 99.0
+    assert stops.tighter_stop(SHORT, 101.0, 100.5) == 100.5
+    assert stops.tighter_stop(SHORT, 0, 101.0) == 101.0
+    assert stops.tighter_stop(SHORT, 101.0, 0) == 101.0
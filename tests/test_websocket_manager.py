@@ -0,0 +1,38 @@
+import queue
+
+from websocket_manager import WebSocketManager
+
+def make_manager():
+    return WebSocketManager('Zerodha', 'token', queue.Queue())
+
+def book_stop(manager, order):
+    [position] = manager.positions[order['instrument_key']]
+    return position.current_stoploss_price
+
+def test_load_positions_builds_the_book_of_open_orders(insert_order):
+    open_order = insert_order()
+    insert_order(status='CLOSED')
+    insert_order(broker='Upstox')
+    manager = make_manager()
+    manager.load_positions()
+    assert [p.id for p in manager.positions[open_order['instrument_key']]] == [open_order['id']]
+
+def test_a_reload_keeps_a_tighter_stop_from_the_book(insert_order):
+    order = insert_order(current_stoploss_price=99.0)
+    manager = make_manager()
+    manager.load_positions()
+    # Trailed on the tick thread after the reload read the row
+    manager.positions[order['instrument_key']][0].current_stoploss_price = 99.8
+    manager.load_positions()
+    assert book_stop(manager, order) == 99.8
+
+def test_a_reload_takes_a_tighter_stop_from_the_database(insert_order, db):
+    order = insert_order(transaction_type='SELL', current_stoploss_price=101.0)
+    manager = make_manager()
+    manager.load_positions()
+    conn = db.get_db_connection()
+    conn.execute('UPDATE orders SET current_stoploss_price = ? WHERE id = ?', (100.4, order['id']))
+    conn.commit()
+    conn.close()
+    manager.load_positions()
+    assert book_stop(manager, order) == 100.4